@@ -0,0 +1,165 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+import pandas as pd
+
+# Filtered AIS data is cached in memory (least recently used entries are dropped past max_bytes) and optionally on disk
+settings = {'max_bytes': 512 * 2**20, 'disk_dir': None}
+memory = OrderedDict() # key -> (DataFrame, size in bytes)
+stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+lock = threading.Lock()
+
+def configure_cache(max_bytes=None, disk_dir=None):
+    """
+    configure_cache() sets the memory budget and the on-disk location of the cache
+    Parameters:
+    max_bytes = the most memory the in-memory cache may use, 0 disables it
+        type = int
+    disk_dir = the directory of the on-disk cache, False disables it
+        type = str
+    Returns:
+    None
+    """
+
+    with lock:
+        if max_bytes is not None:
+            settings['max_bytes'] = max_bytes
+            evict()
+        if disk_dir is not None:
+            settings['disk_dir'] = disk_dir or None
+
+def cache_key(file_path, conditions, columns, compact=False):
+    """
+    cache_key() identifies a filtered read of an AIS file by the file's path, size and modification time, the conditions, the columns, and the types
+    Parameters:
+    file_path = the path of the AIS file
+        type = str
+    conditions = the values to keep for each column, as used by Generic_Mask_Filter()
+        type = dict
+    columns = the columns returned, or None for all columns
+        type = list
+    compact = whether the data is in the compact types (see tools.compact_frame())
+        type = bool
+    Returns:
+    key = the key, or None if the file does not exist
+        type = tuple
+    """
+
+    if not os.path.exists(file_path):
+        return None
+    stat = os.stat(file_path)
+    # repr() keeps '12345' and 12345 apart, since they do not match the same rows
+    filters = tuple(sorted((column, tuple(sorted(repr(value) for value in requirements))) for column, requirements in conditions.items()))
+    return (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, filters, tuple(columns) if columns else None, compact)
+
+def disk_path(key):
+    """
+    disk_path() gives the on-disk cache file of a key, in a folder per AIS file so a file's entries can be invalidated together
+    Parameters:
+    key = the key returned by cache_key()
+        type = tuple
+    Returns:
+    the path of the cache file
+        type = str
+    """
+
+    folder = hashlib.sha1(key[0].encode()).hexdigest()
+    return os.path.join(settings['disk_dir'], folder, hashlib.sha1(repr(key).encode()).hexdigest() + '.pkl')
+
+def evict():
+    """
+    evict() drops the least recently used entries until the in-memory cache fits in its budget (the lock must be held)
+    Returns:
+    None
+    """
+
+    total = sum(size for df, size in memory.values())
+    while memory and total > settings['max_bytes']:
+        key, (df, size) = memory.popitem(last=False)
+        total -= size
+        stats['evictions'] += 1
+
+def cached_read(file_path, conditions, columns, read, compact=False):
+    """
+    cached_read() returns a filtered read of an AIS file from the cache, or reads it and caches it
+    Parameters:
+    file_path = the path of the AIS file
+        type = str
+    conditions = the values to keep for each column, as used by Generic_Mask_Filter()
+        type = dict
+    columns = the columns returned, or None for all columns
+        type = list
+    read = reads the data when it is not cached
+        type = function
+    compact = whether read() returns the data in the compact types, which are cached apart from the full types
+        type = bool
+    Returns:
+    df = the data, which the caller is free to modify (a copy, when the cache holds it)
+        type = pandas.DataFrame
+    """
+
+    key = cache_key(file_path, conditions, columns, compact)
+    if key is None:
+        return read()
+
+    with lock:
+        if key in memory:
+            memory.move_to_end(key)
+            stats['memory_hits'] += 1
+            return memory[key][0].copy()
+
+    if settings['disk_dir'] and os.path.exists(disk_path(key)):
+        df = pd.read_pickle(disk_path(key))
+        with lock:
+            stats['disk_hits'] += 1
+    else:
+        df = read()
+        with lock:
+            stats['misses'] += 1
+        if settings['disk_dir']:
+            os.makedirs(os.path.dirname(disk_path(key)), exist_ok=True)
+            df.to_pickle(disk_path(key) + '.tmp')
+            os.replace(disk_path(key) + '.tmp', disk_path(key))
+
+    # Only frames the cache holds are copied, so a read too large to cache costs no more memory than without the cache;
+    # the shallow size is a lower bound of the deep one, so measuring the strings of a frame that could never fit is skipped
+    if df.memory_usage(deep=False).sum() > settings['max_bytes']:
+        return df
+    size = int(df.memory_usage(deep=True).sum())
+    with lock:
+        held = size <= settings['max_bytes']
+        if held:
+            memory[key] = (df, size)
+            evict()
+    return df.copy() if held else df
+
+def cache_stats():
+    """
+    cache_stats() reports how the cache has been used
+    Returns:
+    the number of memory hits, disk hits, misses and evictions, and the number of entries and bytes held in memory
+        type = dict
+    """
+
+    with lock:
+        return {**stats, 'entries': len(memory), 'bytes': sum(size for df, size in memory.values())}
+
+def invalidate(file_path=None):
+    """
+    invalidate() removes the cached reads of one AIS file, or of every file, from memory and from disk
+    Parameters:
+    file_path = the path of the AIS file, every file by default
+        type = str
+    Returns:
+    None
+    """
+
+    with lock:
+        path = os.path.abspath(file_path) if file_path else None
+        for key in [key for key in memory if path is None or key[0] == path]:
+            del memory[key]
+        if settings['disk_dir']:
+            folder = os.path.join(settings['disk_dir'], hashlib.sha1(path.encode()).hexdigest()) if path else settings['disk_dir']
+            shutil.rmtree(folder, ignore_errors=True)
@@ -0,0 +1,129 @@
+import argparse
+import io
+import os
+import numpy as np
+from tools import ais_day_path, read_ais_csv, apply_conditions
+
+def index_path(file_path):
+    """
+    index_path() gives the path of the MMSI byte-offset index of an AIS csv file
+    Parameters:
+    file_path = the path of the AIS csv file, ex: 'data/AIS_2018_12_31.csv'
+        type = str
+    Returns:
+    the path of the index, ex: 'data/AIS_2018_12_31.mmsi_index.npz'
+        type = str
+    """
+
+    return os.path.splitext(file_path)[0] + '.mmsi_index.npz'
+
+def build_index(file_path):
+    """
+    build_index() scans an AIS csv file once and records, for each MMSI, the byte ranges of the runs of lines that belong to it
+        The csv file itself is left untouched, the index is written next to it
+    Parameters:
+    file_path = the path of the AIS csv file, ex: 'data/AIS_2018_12_31.csv'
+        type = str
+    Returns:
+    index = the path of the index
+        type = str
+    """
+
+    if not file_path.endswith('.csv'):
+        raise Exception("Only extracted csv files can be indexed by byte offset, not " + file_path)
+    stat = os.stat(file_path)
+    run_mmsis, run_starts, run_ends = [], [], []
+    with open(file_path, 'rb') as f:
+        header = f.readline()
+        if not header.startswith(b'MMSI,'):
+            raise Exception("The index needs MMSI to be the first column of " + file_path)
+        offset = len(header)
+        current = None
+        for line in f:
+            mmsi = line[:line.find(b',')]
+            if mmsi != current: # Start a new run whenever the MMSI changes from the previous line
+                run_mmsis.append(mmsi)
+                run_starts.append(offset)
+                run_ends.append(offset)
+                current = mmsi
+            offset += len(line)
+            run_ends[-1] = offset
+
+    # Group the runs by MMSI: the runs of mmsis[i] are starts[ptr[i]:ptr[i+1]]
+    run_mmsis = np.array(run_mmsis, dtype=bytes).astype(str)
+    order = np.argsort(run_mmsis, kind='stable')
+    mmsis, first = np.unique(run_mmsis[order], return_index=True)
+
+    index = index_path(file_path)
+    with open(index + '.tmp', 'wb') as f:
+        np.savez(f, mmsis=mmsis, ptr=np.append(first, len(order)), starts=np.array(run_starts, dtype=np.int64)[order],
+                 ends=np.array(run_ends, dtype=np.int64)[order], header=np.frombuffer(header, dtype=np.uint8),
+                 source=np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64))
+    os.replace(index + '.tmp', index)
+    return index
+
+def load_index(file_path):
+    """
+    load_index() loads the MMSI index of an AIS csv file if it was built from the csv file's current version
+    Parameters:
+    file_path = the path of the AIS csv file
+        type = str
+    Returns:
+    index = the arrays of the index, or None if there is no index (ex: the file is zipped) or the csv file's size or modification time changed
+        type = dict
+    """
+
+    index = index_path(file_path)
+    if not file_path.endswith('.csv') or not os.path.exists(index) or not os.path.exists(file_path):
+        return None
+    stat = os.stat(file_path)
+    with np.load(index) as arrays:
+        index = {name: arrays[name] for name in arrays.files}
+    if index['source'].tolist() != [stat.st_size, stat.st_mtime_ns]:
+        return None
+    return index
+
+def read_indexed(file_path, index, conditions, usecols=None):
+    """
+    read_indexed() reads only the lines of the requested MMSIs from an AIS csv file, by seeking to the byte ranges in its index
+    Parameters:
+    file_path = the path of the AIS csv file
+        type = str
+    index = the index returned by load_index()
+        type = dict
+    conditions = the values to keep for each column, with the same and/or semantics as Generic_Mask_Filter(); must include MMSI
+        type = dict
+    usecols = the columns to parse, all columns by default
+        type = list or callable
+    Returns:
+    df = the data satisfying every condition
+        type = pandas.DataFrame
+    """
+
+    # Look up the byte ranges of every requested MMSI (values that are not strings cannot match, as in Generic_Mask_Filter())
+    mmsis = index['mmsis']
+    ranges = []
+    for mmsi in conditions['MMSI']:
+        i = np.searchsorted(mmsis, mmsi) if isinstance(mmsi, str) else len(mmsis)
+        if i < len(mmsis) and mmsis[i] == mmsi:
+            ranges.extend(zip(index['starts'][index['ptr'][i]:index['ptr'][i + 1]], index['ends'][index['ptr'][i]:index['ptr'][i + 1]]))
+
+    # Read the ranges in file order behind the header, and parse them as a small csv
+    buffer = io.BytesIO()
+    buffer.write(index['header'].tobytes())
+    with open(file_path, 'rb') as f:
+        for start, end in sorted(ranges):
+            f.seek(start)
+            buffer.write(f.read(end - start))
+    buffer.seek(0)
+
+    return apply_conditions(read_ais_csv(buffer, usecols), conditions)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build MMSI byte-offset indexes next to daily AIS csv files")
+    parser.add_argument('days', nargs='+', help="dates in YYYY_MM_DD format, or paths to AIS csv files")
+    args = parser.parse_args()
+
+    for day in args.days:
+        file_path = day if day.endswith('.csv') else ais_day_path(day)
+        print(file_path + " -> " + build_index(file_path))
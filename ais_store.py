@@ -0,0 +1,177 @@
+import argparse
+import os
+import zipfile
+import numpy as np
+from tools import AIS_DTYPES, ais_day_path
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError: # The columnar store is optional, Generic_Mask_Filter() falls back to the CSV without it
+    pa = None
+    pa_csv = None
+    pq = None
+
+ROW_GROUP_SIZE = 65536 # Rows per row group; smaller groups let a single MMSI be read with fewer wasted rows
+
+def store_path(file_path):
+    """
+    store_path() gives the path of the columnar store of an AIS csv file
+    Parameters:
+    file_path = the path of the AIS csv file, ex: 'data/AIS_2018_12_31.csv'
+        type = str
+    Returns:
+    the path of the Parquet store, ex: 'data/AIS_2018_12_31.parquet'
+        type = str
+    """
+
+    return os.path.splitext(file_path)[0] + '.parquet'
+
+def source_identity(file_path):
+    """
+    source_identity() describes the version of an AIS csv file by its size and modification time
+    Parameters:
+    file_path = the path of the AIS csv file
+        type = str
+    Returns:
+    the size in bytes and the modification time in nanoseconds, as strings
+        type = dict
+    """
+
+    stat = os.stat(file_path)
+    return {'source_size': str(stat.st_size), 'source_mtime_ns': str(stat.st_mtime_ns)}
+
+def store_is_current(file_path):
+    """
+    store_is_current() checks whether an AIS csv file has a columnar store that was built from its current version
+    Parameters:
+    file_path = the path of the AIS csv file
+        type = str
+    Returns:
+    True if the store exists and matches the csv file (or the csv file is gone), False otherwise
+        type = bool
+    """
+
+    store = store_path(file_path)
+    if pq is None or store == file_path or not os.path.exists(store):
+        return False
+    if not os.path.exists(file_path): # The raw file may be deleted once it has been ingested
+        return True
+    metadata = pq.read_schema(store).metadata or {}
+    identity = {key.decode(): value.decode() for key, value in metadata.items() if key.startswith(b'source_')}
+    return identity == source_identity(file_path)
+
+def arrow_types():
+    """
+    arrow_types() gives the Arrow types of the AIS columns, matching AIS_DTYPES; BaseDateTime is kept as text, as read_ais_csv() reads it
+    Returns:
+    the type of each column
+        type = dict
+    """
+
+    types = {'BaseDateTime': pa.string()}
+    for column, dtype in AIS_DTYPES.items():
+        types[column] = pa.string() if dtype is str else pa.int64() if dtype == 'Int64' else pa.float64()
+    return types
+
+def ingest(file_path, row_group_size=ROW_GROUP_SIZE):
+    """
+    ingest() converts an AIS csv file into a Parquet store sorted by MMSI and time, so that every row group holds few MMSIs
+        and its statistics let Generic_Mask_Filter() skip the row groups of all other ships
+        The day is parsed and sorted in Arrow, and the sorted rows are written a row group at a time, so ingesting takes about
+        three times the csv file's size in memory (~290 MB for a 105 MB day), where a sorted pandas DataFrame of it took almost five
+    Parameters:
+    file_path = the path of the AIS csv file (or of its zip download), ex: 'data/AIS_2018_12_31.csv'
+        type = str
+    row_group_size = the number of rows in each row group of the store
+        type = int
+    Returns:
+    store = the path of the Parquet store
+        type = str
+    """
+
+    if pq is None:
+        raise ImportError("pyarrow is required to build the columnar store")
+
+    identity = source_identity(file_path)
+    convert = pa_csv.ConvertOptions(column_types=arrow_types(), strings_can_be_null=True)
+    parse = pa_csv.ParseOptions(invalid_row_handler=lambda row: 'skip') # Like read_ais_csv()'s on_bad_lines="skip"
+    if file_path.endswith('.zip'):
+        with zipfile.ZipFile(file_path) as archive, archive.open(archive.namelist()[0]) as f:
+            table = pa_csv.read_csv(f, parse_options=parse, convert_options=convert)
+    else:
+        table = pa_csv.read_csv(file_path, parse_options=parse, convert_options=convert)
+    order = pa.compute.sort_indices(table, sort_keys=[('MMSI', 'ascending'), ('BaseDateTime', 'ascending')])
+
+    # Write the sorted rows a row group at a time, rather than making a sorted copy of the whole day first; the schema records the
+    # csv file's identity so that a re-downloaded file invalidates the store
+    store = store_path(file_path)
+    schema = table.schema.with_metadata(identity)
+    with pq.ParquetWriter(store + '.tmp', schema, write_statistics=True) as writer:
+        for start in range(0, len(table), row_group_size):
+            writer.write_table(table.take(order[start:start + row_group_size]).replace_schema_metadata(identity), row_group_size)
+    os.replace(store + '.tmp', store)
+    return store
+
+def store_values(field, requirements):
+    """
+    store_values() keeps the values of a condition that can equal a value of a column of the store, converted to the column's type,
+        so that a condition written for the csv file (ex: MMSI = [12345], which matches no text MMSI) selects the same rows
+    Parameters:
+    field = the column of the store
+        type = pyarrow.Field
+    requirements = the values to keep for the column
+        type = list
+    Returns:
+    the values that can match, of the column's type
+        type = list
+    """
+
+    if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+        return [value for value in requirements if isinstance(value, str)]
+    numbers = [value for value in requirements if isinstance(value, (int, float, np.number)) and value == value]
+    if pa.types.is_integer(field.type):
+        return [int(value) for value in numbers if float(value).is_integer()]
+    if pa.types.is_floating(field.type):
+        return [float(value) for value in numbers]
+    return list(requirements)
+
+def read_store(file_path, conditions, columns=None):
+    """
+    read_store() reads the columnar store of an AIS csv file, pushing the column projection and the conditions into the read
+    Parameters:
+    file_path = the path of the AIS csv file whose store is read
+        type = str
+    conditions = the values to keep for each column, with the same and/or semantics as Generic_Mask_Filter()
+        type = dict
+    columns = the columns to return, all columns by default
+        type = list
+    Returns:
+    df = the data satisfying every condition
+        type = pandas.DataFrame
+    """
+
+    store = store_path(file_path)
+    schema = pq.read_schema(store)
+    columns = [column for column in schema.names if not columns or column in columns] # Keep the file's column order
+    filters = [(column, 'in', store_values(schema.field(column), requirements)) for column, requirements in conditions.items()]
+    if any(len(values) == 0 for column, operator, values in filters): # Nothing can match, as with the csv file
+        table = pa.schema([schema.field(column) for column in columns]).empty_table()
+    else:
+        table = pq.read_table(store, columns=columns, filters=filters or None)
+
+    # Integer columns with missing values come out of Arrow as floats; give them the csv file's nullable integers
+    df = table.to_pandas()
+    return df.astype({column: dtype for column, dtype in AIS_DTYPES.items() if dtype == 'Int64' and column in df.columns})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert daily AIS csv files into MMSI-sorted Parquet stores")
+    parser.add_argument('days', nargs='+', help="dates in YYYY_MM_DD format, or paths to AIS csv or zip files")
+    parser.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE)
+    args = parser.parse_args()
+
+    for day in args.days:
+        file_path = day if day.endswith(('.csv', '.zip')) else ais_day_path(day)
+        print(file_path + " -> " + ingest(file_path, args.row_group_size))
@@ -1,9 +1,12 @@
+import logging
 import pandas as pd
-import numpy as np
-from tools import Generic_Mask_Filter, pos_angle, true_difference
+from instrumentation import stage
+from tools import Generic_Mask_Filter, ais_day_path, angle_difference, normalize_sentinels
+
+logger = logging.getLogger(__name__)
 
 # Code written by Lemon Doroshow
-def csvgen(path, MMSI, output=False):
+def csvgen(path, MMSI, output=False, data=None):
     """csvgen() generates a csv of a ship's longitude, latitude, and datetime (in UTC)
     Parameters:
     path = The date of an AIS csv file; ex: for the file AIS_2018_12_31.csv, path = '2018_12_31' in YYYY_MM_DD format
@@ -12,6 +15,8 @@ def csvgen(path, MMSI, output=False):
         type = str (returns an empty dataframe if MMSI is entered as an int or float)"
     output = Where to return the csv file and its name, defaults to the data folder with the name 'coordinates_' + path + '.csv' 
         type = str
+    data = the ship's AIS data if it was already imported with Generic_Mask_Filter(), so the day's file is not read again
+        type = pandas.DataFrame
     Returns:
     csv file in a given path with a given name"""
 
@@ -21,18 +26,21 @@ def csvgen(path, MMSI, output=False):
     else:
         output='data/coordinates_' + path + '.csv'
 
-    # Import filtered AIS data
-    data = Generic_Mask_Filter(("data/AIS_" + path + '.csv'), MMSI=[MMSI])
+    # Import filtered AIS data, with unavailable speeds, courses and headings as NaN
+    if data is None:
+        data = Generic_Mask_Filter(ais_day_path(path), MMSI=[MMSI])
+    data = normalize_sentinels(data)
 
-    # Adjust times and speeds over ground, calculate angle differences
-    times_adjusted=[x.strftime('%c') for x in  pd.to_datetime(data["BaseDateTime"])]
-    sogs = [np.nan if sog >= 102.3 else sog for sog in [sog + 102.4 if sog < 0 else sog for sog in data['SOG']]]
-    angle_diffs = [np.nan if cog == 360.0 or heading == 511.0 else true_difference(pos_angle(cog),pos_angle(heading)) for cog, heading in zip([cog + 409.6 if cog < 0 else cog for cog in data['COG']], data['Heading'])]
+    # Sort by the parsed times (not by their text, which would not be chronological), calculate angle differences
+    data = data.sort_values('BaseDateTime')
+    sogs = data['SOG']
+    angle_diffs = angle_difference(data['COG'], data['Heading'])
 
-    # Convert data to pd.DataFrame
-    mapped_data = {'longitude':data['LON'], 'latitude':data['LAT'], 'time':times_adjusted, 'SOG':sogs, 'Angle Difference':angle_diffs}
+    # Convert data to pd.DataFrame, formatting the times only once they are in order
+    mapped_data = {'longitude':data['LON'], 'latitude':data['LAT'], 'time':data['BaseDateTime'].dt.strftime('%c'), 'SOG':sogs, 'Angle Difference':angle_diffs}
     mapped_df = pd.DataFrame(mapped_data)
-    mapped_df = mapped_df.sort_values('time')
 
     # Export csv file
-    mapped_df.to_csv(path_or_buf=output, index=False)
+    with stage('write'):
+        mapped_df.to_csv(path_or_buf=output, index=False)
+    logger.info("Wrote %d points of ship %s to %s", len(mapped_df), MMSI, output)
@@ -0,0 +1,212 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError: # Not on Windows, where peak memory falls back to tracemalloc, which only sees Python's own allocations
+    resource = None
+import matplotlib
+matplotlib.use('Agg') # Plots are timed without a display
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from ais_cache import invalidate
+from ais_index import build_index, index_path
+from ais_store import ingest, store_path
+from arcgis_datagen import csvgen
+from bridge_pass_collection import bridge_reader, param_collection, param_collection_batch
+from cleaned_ship_graphing import change_graph, incident_graph, param_hist
+from synthetic_ais import generate_day
+from tools import Generic_Mask_Filter
+
+DATE = '2019_03_01'
+SCALES = {'small': (200, 500), 'medium': (2000, 500), 'large': (10000, 500)} # Ships and broadcasts per ship, ~0.1, 1 and 5 million rows
+SAMPLE_PASSES = 5 # param_collection() reads the whole day for every pass, so it is timed on the first few passes only
+MEASURE_RSS = resource is not None and 'fork' in multiprocessing.get_all_start_methods() # Else peak memory is traced with tracemalloc
+
+def peak_memory(function):
+    """
+    peak_memory() measures how far a function raises the peak resident memory of the process, run once in a forked child process
+        so the peak of one case does not hide the next; unlike tracemalloc this counts Arrow's and the pandas C parser's buffers
+    Parameters:
+    function = the function to measure, called without arguments
+        type = function
+    Returns:
+    peak_mb = the peak resident memory of the child above its resident memory when it started, in megabytes
+        type = float
+    """
+
+    if not MEASURE_RSS:
+        invalidate()
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        plt.close('all')
+        return peak / 2**20
+
+    context = multiprocessing.get_context('fork')
+    receive, send = context.Pipe(duplex=False)
+
+    def child():
+        start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # A forked child starts at its parent's current resident memory
+        invalidate()
+        function()
+        send.send(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start)
+
+    process = context.Process(target=child)
+    process.start()
+    send.close()
+    try:
+        growth = receive.recv()
+    except EOFError:
+        raise Exception("The memory of a benchmark could not be measured, its process failed!")
+    finally:
+        process.join()
+    return growth * (1 if sys.platform == 'darwin' else 1024) / 2**20 # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+
+def measure(function, repeat):
+    """
+    measure() times a function and measures its peak memory (see peak_memory())
+    Parameters:
+    function = the function to measure, called without arguments
+        type = function
+    repeat = how many times to time it; the fastest time is kept
+        type = int
+    Returns:
+    seconds = the fastest time
+        type = float
+    peak_mb = the most memory it took while it ran once more, in megabytes
+        type = float
+    """
+
+    times = []
+    for i in range(repeat):
+        invalidate() # Every run reads its data again
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+        plt.close('all')
+
+    return min(times), peak_memory(function)
+
+def benchmark_scale(scale, folder, repeat):
+    """
+    benchmark_scale() generates (or reuses) the synthetic data of one scale and measures every stage of the pipeline on it
+    Parameters:
+    scale = one of the names in SCALES
+        type = str
+    folder = where the synthetic data of every scale is kept
+        type = str
+    repeat = how many times to time each stage
+        type = int
+    Returns:
+    results = one dictionary per stage, with the scale, the number of rows, the stage, its time and its peak memory
+        type = list
+    """
+
+    vessels, points = SCALES[scale]
+    work = os.path.abspath(os.path.join(folder, scale + '_' + str(vessels) + 'x' + str(points)))
+    ais = 'data/AIS_' + DATE + '.csv'
+    bridge = 'data/bridge_' + DATE + '.csv'
+    sample = 'data/bridge_sample.csv'
+
+    # The pipeline reads data/AIS_<date>.csv relative to the working directory
+    cwd = os.getcwd()
+    os.makedirs(work, exist_ok=True)
+    os.chdir(work)
+    try:
+        if not os.path.exists(bridge):
+            generate_day(DATE, vessels, points)
+        pd.read_csv(bridge, dtype=str).iloc[:2 * SAMPLE_PASSES].to_csv(sample, index=False)
+        for sidecar in (index_path(ais), store_path(ais)):
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
+        rows = sum(1 for line in open(ais)) - 1
+        mmsi = str(bridge_reader(bridge)['MMSI'].iloc[0])
+
+        cases = [('Generic_Mask_Filter csv', lambda: Generic_Mask_Filter(ais, MMSI=[mmsi], cache=False)),
+                 ('Generic_Mask_Filter chunked', lambda: Generic_Mask_Filter(ais, MMSI=[mmsi], chunksize=100000, cache=False)),
+                 ('Generic_Mask_Filter projected', lambda: Generic_Mask_Filter(ais, MMSI=[mmsi], columns=['BaseDateTime', 'LAT', 'LON'], cache=False)),
+                 ('bridge_reader', lambda: bridge_reader(bridge)),
+                 ('param_collection ' + str(SAMPLE_PASSES) + ' passes', lambda: param_collection(sample, 'SOG')),
+                 ('param_collection_batch', lambda: param_collection_batch(bridge, ['SOG', 'COG', 'Angle Difference'])),
+                 ('csvgen', lambda: csvgen(DATE, mmsi, output='data/coordinates_benchmark.csv')),
+                 ('incident_graph', lambda: incident_graph(DATE, mmsi)),
+                 ('change_graph', lambda: change_graph(DATE, mmsi, 'Difference')),
+                 ('param_hist', lambda: param_hist(DATE, mmsi, 'Angle Difference')),
+                 ('ais_index build', lambda: build_index(ais)),
+                 ('Generic_Mask_Filter indexed', lambda: Generic_Mask_Filter(ais, MMSI=[mmsi], cache=False)),
+                 ('ais_store ingest', lambda: ingest(ais)), # The store is read before the index, so the index can stay
+                 ('Generic_Mask_Filter store', lambda: Generic_Mask_Filter(ais, MMSI=[mmsi], cache=False))]
+
+        results = []
+        for case, function in cases:
+            seconds, peak_mb = measure(function, repeat)
+            results.append({'scale': scale, 'rows': rows, 'case': case, 'seconds': seconds, 'peak_mb': peak_mb})
+            print(scale.ljust(8) + case.ljust(36) + ('%.4f s' % seconds).rjust(12) + ('%.1f MB' % peak_mb).rjust(12))
+        for sidecar in (index_path(ais), store_path(ais)): # Leave the raw day file as the only source for the next run
+            os.remove(sidecar)
+    finally:
+        os.chdir(cwd)
+    return results
+
+def environment():
+    """
+    environment() describes where the benchmarks ran, so reports from different machines or commits are not mixed up
+    Returns:
+    the commit, the Python, pandas and numpy versions, the machine, how peak memory was measured, and the time
+        type = dict
+    """
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+            'machine': platform.machine(), 'processor': platform.processor(),
+            'memory': 'rss' if MEASURE_RSS else 'tracemalloc', 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def compare(results, baseline):
+    """
+    compare() prints how each stage's time changed from a previous report
+    Parameters:
+    results = the results of this run
+        type = list
+    baseline = a previous report written by this script
+        type = dict
+    Returns:
+    None
+    """
+
+    before = {(result['scale'], result['case']): result for result in baseline['results']}
+    print("\nCompared with " + str(baseline['environment'].get('commit')) + ":")
+    for result in results:
+        old = before.get((result['scale'], result['case']))
+        if old:
+            print(result['scale'].ljust(8) + result['case'].ljust(36) + ('x%.2f time' % (result['seconds'] / old['seconds'])).rjust(12)
+                  + ('x%.2f memory' % (result['peak_mb'] / old['peak_mb'] if old['peak_mb'] else 1)).rjust(14))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time and memory-profile the AIS pipeline on synthetic data")
+    parser.add_argument('scales', nargs='*', default=['small', 'medium'], help="any of " + ', '.join(SCALES))
+    parser.add_argument('--folder', default='bench', help="where the synthetic data is generated and kept")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='bench/report.json', help="path of the JSON report")
+    parser.add_argument('--compare', default=None, help="a previous JSON report to compare against")
+    args = parser.parse_args()
+
+    results = [result for scale in args.scales for result in benchmark_scale(scale, args.folder, args.repeat)]
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
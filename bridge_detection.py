@@ -0,0 +1,258 @@
+import argparse
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from instrumentation import count, stage
+from tools import AIS_TIME_FORMAT, ais_day_path, read_ais_csv
+
+logger = logging.getLogger(__name__)
+
+# Bridges are found in the AIS data in two steps: a grid prefilter keeps only the broadcasts in the cells around a bridge, then the steps
+# between consecutive broadcasts of each ship in those cells are tested against the bridge segments registered in the step's cell
+GRID_DEGREES = 0.01 # Side of a grid cell, ~0.7 miles; a pass whose points either side are further apart than this is not detected
+CHUNKSIZE = 1000000 # Rows of a day file read at a time
+
+def read_bridges(path):
+    """
+    read_bridges() reads the geometry of a set of bridges, with one row per vertex of each bridge's span, in order along the span
+        Bridge,LAT,LON
+        Fred Hartman,29.7025,-95.0159       A bridge with two vertices is a single segment; more vertices make a line that follows the span.
+        Fred Hartman,29.7131,-95.0082       A footprint can be given by repeating its first vertex at the end, but the ship
+        Sidney Sherman,29.7269,-95.2655     must cross one of its edges, ex: its centreline, so a span is best given as the line it covers
+        Sidney Sherman,29.7388,-95.2566
+    Parameters:
+    path = the bridge geometry csv file's path
+        type = str
+    Returns:
+    segments = one row per segment, with the bridge's name and the LAT and LON of both ends
+        type = pandas.DataFrame
+    """
+
+    vertices = pd.read_csv(path, dtype={'Bridge': str})
+    segments = []
+    for bridge, points in vertices.groupby('Bridge', sort=False):
+        if len(points) < 2:
+            raise Exception("The bridge '" + bridge + "' needs at least two vertices!")
+        segments.append(pd.DataFrame({'Bridge': bridge, 'LAT1': points['LAT'].to_numpy()[:-1], 'LON1': points['LON'].to_numpy()[:-1],
+                                      'LAT2': points['LAT'].to_numpy()[1:], 'LON2': points['LON'].to_numpy()[1:]}))
+    return pd.concat(segments, ignore_index=True)
+
+def grid_cells(lat, lon, cell=GRID_DEGREES):
+    """
+    grid_cells() gives the number of the grid cell of each point
+    Parameters:
+    lat = the latitudes
+        type = numpy.ndarray or pandas.Series
+    lon = the longitudes
+        type = numpy.ndarray or pandas.Series
+    cell = the side of a cell, in degrees
+        type = float
+    Returns:
+    cells = the cell of each point
+        type = numpy.ndarray
+    """
+
+    columns = int(np.ceil(360 / cell)) + 1
+    return np.floor((np.asarray(lat, dtype=np.float64) + 90) / cell).astype(np.int64) * columns \
+        + np.floor((np.asarray(lon, dtype=np.float64) + 180) / cell).astype(np.int64)
+
+def bridge_grid(segments, cell=GRID_DEGREES):
+    """
+    bridge_grid() registers each segment in every cell of its bounding box and the cells around it, so that any step shorter than a cell
+        that crosses the segment starts in one of them
+    Parameters:
+    segments = the bridge segments, as returned by read_bridges()
+        type = pandas.DataFrame
+    cell = the side of a cell, in degrees
+        type = float
+    Returns:
+    cells = the registered cells, sorted
+        type = numpy.ndarray
+    members = the segment registered in each of those cells (a cell appears once per segment)
+        type = numpy.ndarray
+    """
+
+    cells, members = [], []
+    for i, segment in enumerate(segments.itertuples()):
+        rows = np.arange(np.floor((min(segment.LAT1, segment.LAT2) + 90) / cell) - 1, np.floor((max(segment.LAT1, segment.LAT2) + 90) / cell) + 2)
+        columns = np.arange(np.floor((min(segment.LON1, segment.LON2) + 180) / cell) - 1, np.floor((max(segment.LON1, segment.LON2) + 180) / cell) + 2)
+        box = (rows[:, None] * (int(np.ceil(360 / cell)) + 1) + columns[None, :]).astype(np.int64).ravel()
+        cells.append(box)
+        members.append(np.full(len(box), i))
+    cells, members = np.concatenate(cells), np.concatenate(members)
+    order = np.argsort(cells, kind='stable')
+    return cells[order], members[order]
+
+def orientation(lat1, lon1, lat2, lon2, lat, lon):
+    """
+    orientation() gives which side of the line through two points each point is on, positive to the left
+        LAT and LON are used as plane coordinates, which keeps the side of every point at the scale of a bridge
+    Parameters:
+    lat1, lon1, lat2, lon2 = the two points of the line
+        type = numpy.ndarray
+    lat, lon = the points
+        type = numpy.ndarray
+    Returns:
+    the cross product of the line and the point
+        type = numpy.ndarray
+    """
+
+    return (lon2 - lon1) * (lat - lat1) - (lat2 - lat1) * (lon - lon1)
+
+def crossing_steps(steps, segments, grid, cell=GRID_DEGREES):
+    """
+    crossing_steps() tests every step against the segments registered in the cell of its first point, all at once
+        A point exactly on a bridge counts as being to its right, so a ship that stops on a bridge line is not counted twice
+    Parameters:
+    steps = the steps, with the LAT and LON of both points in 'LAT1', 'LON1', 'LAT2', 'LON2'
+        type = pandas.DataFrame
+    segments = the bridge segments, as returned by read_bridges()
+        type = pandas.DataFrame
+    grid = the cells and members returned by bridge_grid()
+        type = tuple
+    cell = the side of a cell, in degrees
+        type = float
+    Returns:
+    step = the position in steps of each crossing
+        type = numpy.ndarray
+    bridge = the name of the bridge of each crossing
+        type = numpy.ndarray
+    """
+
+    # Pair each step with the segments of its cell
+    cells, members = grid
+    first = grid_cells(steps['LAT1'], steps['LON1'], cell)
+    start, end = np.searchsorted(cells, first, 'left'), np.searchsorted(cells, first, 'right')
+    step = np.repeat(np.arange(len(steps)), end - start)
+    segment = members[np.repeat(end - (end - start).cumsum(), end - start) + np.arange((end - start).sum())] if len(step) else step
+    count('segment_tests', len(step))
+
+    # The step and the segment cross when the ends of each are on opposite sides of the other
+    a = {column: steps[column].to_numpy()[step] for column in ['LAT1', 'LON1', 'LAT2', 'LON2']}
+    b = {column: segments[column].to_numpy()[segment] for column in ['LAT1', 'LON1', 'LAT2', 'LON2']}
+    sides = (orientation(b['LAT1'], b['LON1'], b['LAT2'], b['LON2'], a['LAT1'], a['LON1']) > 0) \
+        != (orientation(b['LAT1'], b['LON1'], b['LAT2'], b['LON2'], a['LAT2'], a['LON2']) > 0)
+    ends = (orientation(a['LAT1'], a['LON1'], a['LAT2'], a['LON2'], b['LAT1'], b['LON1']) > 0) \
+        != (orientation(a['LAT1'], a['LON1'], a['LAT2'], a['LON2'], b['LAT2'], b['LON2']) > 0)
+
+    # A step crossing two segments of the same bridge, at a vertex, is one pass
+    crossed = pd.DataFrame({'step': step[sides & ends], 'bridge': segments['Bridge'].to_numpy()[segment[sides & ends]]}).drop_duplicates()
+    return crossed['step'].to_numpy(), crossed['bridge'].to_numpy()
+
+def scan_day(file_path, segments, cell=GRID_DEGREES, chunksize=CHUNKSIZE):
+    """
+    scan_day() finds every bridge pass in a day of AIS data
+    Parameters:
+    file_path = the path of the AIS csv (or zip) file
+        type = str
+    segments = the bridge segments, as returned by read_bridges()
+        type = pandas.DataFrame
+    cell = the side of a grid cell, in degrees
+        type = float
+    chunksize = the number of rows of the file to read at a time
+        type = int
+    Returns:
+    passes = the AIS rows before and after each pass, as they are in the file, alternating, with the 'Bridge' passed under
+        type = pandas.DataFrame
+    """
+
+    grid = bridge_grid(segments, cell)
+    zone = np.unique(grid[0])
+
+    # Keep the full rows near a bridge, and only the ship and time of the others, to know which broadcasts follow each other
+    near, ships, times, rows = [], [], [], []
+    with stage('read'):
+        for chunk in read_ais_csv(file_path, chunksize=chunksize):
+            in_zone = np.isin(grid_cells(chunk['LAT'], chunk['LON'], cell), zone)
+            near.append(chunk[in_zone])
+            ships.append(chunk['MMSI'])
+            times.append(pd.to_datetime(chunk['BaseDateTime'], format=AIS_TIME_FORMAT, errors='coerce'))
+            rows.append(in_zone)
+            count('rows_scanned', len(chunk))
+    if not near:
+        return pd.DataFrame(columns=['Bridge'])
+    near = pd.concat(near)
+    ships, times, in_zone = pd.concat(ships, ignore_index=True), pd.concat(times, ignore_index=True), np.concatenate(rows)
+    logger.debug("%d of %d rows of %s are near a bridge", len(near), len(in_zone), file_path)
+
+    # Order every ship's broadcasts by time; a step joins two consecutive broadcasts of a ship that are both near a bridge
+    with stage('window'):
+        codes = pd.factorize(ships)[0]
+        order = np.lexsort((times.to_numpy(), codes))
+        follows = (codes[order][1:] == codes[order][:-1]) & (codes[order][:-1] >= 0) & in_zone[order][1:] & in_zone[order][:-1]
+        before, after = order[:-1][follows], order[1:][follows]
+        steps = pd.DataFrame({'LAT1': near.loc[before, 'LAT'].to_numpy(), 'LON1': near.loc[before, 'LON'].to_numpy(),
+                              'LAT2': near.loc[after, 'LAT'].to_numpy(), 'LON2': near.loc[after, 'LON'].to_numpy()})
+        step, bridge = crossing_steps(steps, segments, grid, cell)
+
+    # Interleave the rows before and after each pass, as in the pre-compiled bridge files
+    passes = pd.concat([near.loc[before[step]].assign(Bridge=bridge, pass_=np.arange(len(step)), side=0),
+                        near.loc[after[step]].assign(Bridge=bridge, pass_=np.arange(len(step)), side=1)])
+    passes = passes.sort_values(['pass_', 'side']).drop(columns=['pass_', 'side']).reset_index(drop=True)
+    count('passes', len(step))
+    logger.info("%d passes in %s", len(step), file_path)
+    return passes
+
+def bridge_file(folder, bridge):
+    """
+    bridge_file() gives the path of the pass file of a bridge
+    Parameters:
+    folder = the folder of the pass files
+        type = str
+    bridge = the bridge's name, ex: 'Fred Hartman'
+        type = str
+    Returns:
+    the path, ex: 'bridges/fredhartman.csv'
+        type = str
+    """
+
+    return os.path.join(folder, re.sub(r'[^a-z0-9]', '', bridge.lower()) + '.csv')
+
+def detect_passes(dates, bridges, folder='data', output='bridges', workers=None):
+    """
+    detect_passes() scans the AIS files of a set of days for the passes under a set of bridges, one day per process,
+        and writes one pass file per bridge, in the format bridge_reader() reads
+    Parameters:
+    dates = the days to scan, in YYYY_MM_DD format
+        type = list
+    bridges = the bridge geometry csv file's path (see read_bridges())
+        type = str
+    folder = the folder of the AIS files
+        type = str
+    output = the folder to write the pass files to
+        type = str
+    workers = the number of processes, the number of CPUs by default
+        type = int
+    Returns:
+    files = the pass file of each bridge, ex: {'Fred Hartman': 'bridges/fredhartman.csv'}
+        type = dict
+    """
+
+    segments = read_bridges(bridges)
+    paths = [ais_day_path(date, folder) for date in sorted(dates)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        days = list(pool.map(scan_day, paths, [segments] * len(paths)))
+
+    # Every bridge gets a file, even without passes, in date order
+    os.makedirs(output, exist_ok=True)
+    passes = pd.concat(days, ignore_index=True)
+    files = {}
+    for bridge in segments['Bridge'].unique():
+        files[bridge] = bridge_file(output, bridge)
+        passes[passes['Bridge'] == bridge].drop(columns=['Bridge']).to_csv(files[bridge], index=False)
+    return files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find the passes under a set of bridges in daily AIS files, and write a bridge csv file per bridge")
+    parser.add_argument('bridges', help="csv file of the bridges' vertices, with Bridge, LAT and LON columns")
+    parser.add_argument('dates', nargs='+', help="dates in YYYY_MM_DD format")
+    parser.add_argument('--folder', default='data', help="folder of the AIS files")
+    parser.add_argument('--output', default='bridges', help="folder to write the pass files to")
+    parser.add_argument('--workers', type=int, default=None, help="number of processes, the number of CPUs by default")
+    args = parser.parse_args()
+
+    for bridge, path in detect_passes(args.dates, args.bridges, args.folder, args.output, args.workers).items():
+        print(bridge + " -> " + path)
@@ -1,20 +1,89 @@
-import matplotlib.pyplot as plt
+import itertools
+import logging
 import numpy as np
 import pandas as pd
-import seaborn as sns
-from geopy import distance
-from tools import Generic_Mask_Filter, pos_angle, true_difference
+from instrumentation import count, stage
+from tools import AIS_TIME_FORMAT, Generic_Mask_Filter, ais_day_path, along_track_distance, angle_difference, normalize_sentinels, prefetch
+
+logger = logging.getLogger(__name__)
 
 # Code written by Lemon Doroshow
-def bridge_reader(path):
+def pair_passes(df, start=0):
+    """
+    pair_passes() pairs the AIS data points before and after each pass, which alternate in a bridge csv file
+    Parameters:
+    df = the rows of a bridge csv file, without duplicated heading rows, starting with the point before a pass
+        type = pandas.DataFrame
+    start = the index of the first pass, so that passes read in chunks keep unique indexes
+        type = int
+    Returns
+    passes_paired = pandas dataframe containing the MMSI, date, and times (as datetime64) before and after each pass
+        type = pandas.DataFrame
+    midnight = the passes whose points before and after are on different days
+        type = pandas.DataFrame
+    invalid = the rows that do not make a pass: pairs whose points before and after are of different ships (ex: a bad line of the
+        file was skipped, shifting every later pair), and an unpaired last row; these are in neither of the other two
+        type = pandas.DataFrame
+    """
+
+    # Even rows are the points before each pass and odd rows the points after it
+    initials = df.iloc[0::2].reset_index(drop=True)
+    finals = df.iloc[1::2].reset_index(drop=True)
+    unpaired = initials.iloc[len(finals):]
+    initials = initials.iloc[:len(finals)]
+
+    # Pair the data for each pass into a single dataframe object, dated by the point before the pass
+    times_before = pd.to_datetime(initials['BaseDateTime'], format=AIS_TIME_FORMAT)
+    times_after = pd.to_datetime(finals['BaseDateTime'], format=AIS_TIME_FORMAT)
+    passes_paired = pd.DataFrame({'MMSI':initials['MMSI'], 'date':times_before.dt.strftime('%Y_%m_%d'), 'time_before':times_before,
+                                  'time_after':times_after, 'Width':initials['Width']})
+    passes_paired.index = pd.RangeIndex(start, start + len(passes_paired))
+
+    mismatched = (initials['MMSI'].astype(str).str.strip() != finals['MMSI'].astype(str).str.strip()).to_numpy()
+    invalid = pd.DataFrame({'MMSI_before':initials['MMSI'].astype(object), 'time_before':initials['BaseDateTime'],
+                            'MMSI_after':finals['MMSI'].astype(object), 'time_after':finals['BaseDateTime']})[mismatched]
+    invalid = pd.concat([invalid, pd.DataFrame({'MMSI_before':unpaired['MMSI'].astype(object), 'time_before':unpaired['BaseDateTime']})])
+    invalid.index = start + np.r_[np.flatnonzero(mismatched), np.arange(len(finals), len(finals) + len(unpaired))]
+
+    midnight = (times_before.dt.normalize() != times_after.dt.normalize()).to_numpy()
+    return passes_paired[~midnight & ~mismatched], passes_paired[midnight & ~mismatched], invalid
+
+def pass_exception(midnight, invalid):
+    """
+    pass_exception() builds one exception reporting every pass where the ship passed under a bridge at midnight and every pair of
+        rows that does not make a pass
+    Parameters:
+    midnight = the passes whose points before and after are on different days, as returned by pair_passes()
+        type = pandas.DataFrame
+    invalid = the rows that do not make a pass, as returned by pair_passes()
+        type = pandas.DataFrame
+    Returns:
+    an exception listing the passes and the rows
+        type = Exception
+    """
+
+    messages = []
+    if len(invalid):
+        messages.append(str(len(invalid)) + " pair(s) of rows are not the points before and after a pass of one ship!\n" + invalid.to_string())
+    if len(midnight):
+        # Since we base the date off of our initial pass, we would want to know if the initial and final pass aren't on the same day
+        messages.append(str(len(midnight)) + " ship(s) passed under a bridge at midnight!\n" + midnight.to_string())
+    return Exception('\n'.join(messages))
+
+def bridge_reader(path, midnight=False):
     """
     bridge_reader() imports a pre-made csv including all of the AIS data points before and after a ship passes under a ship
     Parameters:
-    path = the bridge csv file's path - MUST BE a csv file pre-compiled from our GitHub repo
+    path = the bridge csv file's path - MUST BE a csv file pre-compiled from our GitHub repo (or written by bridge_detection.py)
         type = str
+    midnight = if True, passes at midnight are returned with the others, dated by the point before the pass, for functions that
+        read across days (see vessel_track.py)
+        type = bool
     Returns
     passes_paired = pandas dataframe containing the MMSI, date, and times before and after each pass
         type = pandas.DataFrame
+    Raises one exception listing every pair of rows that is not a pass of one ship, and every pass that happened at midnight if
+        midnight is False, if there are any
     """
 
     # Import csv
@@ -22,107 +91,286 @@ def bridge_reader(path):
 
     # Remove duplicated heading rows
     df = df[df['MMSI'] != 'MMSI']
-    df.reset_index(drop=True, inplace=True)
-
-    # Define dataframe objects for before and after each pass
-    passes = pd.DataFrame({'MMSI':df['MMSI'], 'BaseDateTime':df['BaseDateTime'], 'Width':df['Width']})
-    initials = passes[passes.index % 2 == 0]
-    finals = passes[passes.index % 2 == 1]
-
-    # Pair the data for each pass into a single dataframe object
-    passes_paired = pd.DataFrame({'MMSI':[], 'date':[], 'time_before':[], 'time_after':[], 'Width':[]})
-    for i, f in zip(initials.itertuples(), finals.itertuples()):
-        if i.BaseDateTime[:10] != f.BaseDateTime[:10]: # Since we base the date off of our initial pass,
-            raise Exception("The ship passed under a bridge at midnight!") # we would want to know if the initial and final pass aren't on the same day
-        pairing = {'MMSI':i.MMSI, 'date':i.BaseDateTime[:10].replace('-','_'), 'time_before':i.BaseDateTime, 'time_after':f.BaseDateTime, 'Width':i.Width}
-        passes_paired.loc[len(passes_paired)] = pairing
+
+    passes_paired, midnights, invalid = pair_passes(df)
+    count('passes', len(passes_paired) + len(midnights))
+    if midnight:
+        passes_paired = pd.concat([passes_paired, midnights]).sort_index()
+        midnights = midnights.iloc[0:0]
+    if len(midnights) or len(invalid):
+        raise pass_exception(midnights, invalid)
     
     return passes_paired
 
-def param_collection(path, param, large=False):
+def paired_chunks(path, chunksize):
+    """
+    paired_chunks() reads a bridge csv file in chunks and pairs the passes of each chunk with pair_passes()
+    Parameters:
+    path = the bridge csv file's path
+        type = str
+    chunksize = the number of rows of the file to read at a time
+        type = int
+    Returns:
+    an iterator of pair_passes()'s passes, midnight passes and invalid rows for each chunk, with unique indexes across chunks
+        type = generator
+    """
+
+    leftover = None # A point before a pass whose point after is in the next chunk
+    start = 0
+    for df in pd.read_csv(path, sep=',', header=0, usecols=['MMSI', 'BaseDateTime', 'Width'], dtype={'MMSI':str, 'BaseDateTime':str},
+                          on_bad_lines="skip", chunksize=chunksize):
+
+        # Remove duplicated heading rows, and carry an unpaired last row over to the next chunk
+        df = df[df['MMSI'] != 'MMSI']
+        if leftover is not None:
+            df = pd.concat([leftover, df])
+        leftover = df.iloc[-1:] if len(df) % 2 else None
+        paired = pair_passes(df.iloc[:len(df) - len(df) % 2], start)
+        start += len(df) // 2
+        yield paired
+
+    if leftover is not None: # The file ends with an unpaired row
+        yield pair_passes(leftover, start)
+
+def bridge_reader_chunks(path, chunksize=10000, midnight=False):
+    """
+    bridge_reader_chunks() pairs the passes of a bridge csv file like bridge_reader(), reading the file in chunks instead of all at once
+    Parameters:
+    path = the bridge csv file's path - MUST BE a csv file pre-compiled from our GitHub repo
+        type = str
+    chunksize = the number of rows of the file to read at a time
+        type = int
+    midnight = if True, passes at midnight are returned with the others (see bridge_reader())
+        type = bool
+    Returns
+    an iterator of pandas dataframes containing the MMSI, date, and times before and after each pass, with unique indexes across chunks
+        type = generator
+    Raises the same exception as bridge_reader() before the first chunk is returned, since the whole file is checked first
+    """
+
+    # Check every pair of the file before any pass is used, as bridge_reader() does
+    midnights, invalid = [], []
+    for passes_paired, midnight_passes, invalid_rows in paired_chunks(path, chunksize):
+        midnights.append(midnight_passes.iloc[0:0] if midnight else midnight_passes)
+        invalid.append(invalid_rows)
+    midnights = pd.concat(midnights) if midnights else pd.DataFrame()
+    invalid = pd.concat(invalid) if invalid else pd.DataFrame()
+    if len(midnights) or len(invalid):
+        raise pass_exception(midnights, invalid)
+
+    for passes_paired, midnight_passes, invalid_rows in paired_chunks(path, chunksize):
+        count('passes', len(passes_paired) + len(midnight_passes))
+        if midnight:
+            passes_paired = pd.concat([passes_paired, midnight_passes]).sort_index()
+        if len(passes_paired):
+            yield passes_paired
+
+def large_passes(bridge_df):
+    """
+    large_passes() keeps the passes of ships at least 150 wide
+    Parameters:
+    bridge_df = the passes returned by bridge_reader()
+        type = pandas.DataFrame
+    Returns:
+    bridge_df = the passes with a known Width of 150 or more
+        type = pandas.DataFrame
+    """
+
+    bridge_df = bridge_df[bridge_df['Width'].notna()]
+    bridge_df['Width'] = bridge_df['Width'].astype(int)
+    return bridge_df[bridge_df['Width'] >= 150]
+
+def param_filter(data, param):
+    """
+    param_filter() removes the AIS points where a parameter is not available, adjusts its encoded values, sorts the points by time,
+        and adds the cumulative along-track 'Distance' (in miles) of each remaining point
+    Parameters:
+    data = one ship's AIS data for a day, as returned by Generic_Mask_Filter()
+        type = pandas.DataFrame
+    param = the parameter about to be collected (see param_collection())
+        type = str
+    Returns:
+    data = the filtered data, sorted by time with a fresh index and a 'Distance' column
+        type = pandas.DataFrame
+    """
+
+    data = normalize_sentinels(data)
+    if param in ['COG', 'Heading', 'SOG']:
+        data = data.dropna(subset=[param])
+    elif param == 'Angle Difference':
+        data = data.dropna(subset=['COG', 'Heading'])
+    else: 
+        pass
+    with stage('normalise'):
+        data = data.sort_values(by='BaseDateTime')
+        data.reset_index(drop=True, inplace=True)
+        data['Distance'] = along_track_distance(data['LAT'], data['LON'])
+    return data
+
+def window_bounds(distances, index_before, index_after, radius):
+    """
+    window_bounds() finds the points within a radius upstream and downstream of a pass, as the original point-by-point loops did:
+        each side starts at its point of the pass, and the distance walked is counted from the step across the bridge, before the
+        next point is taken, so a point is kept while the distance walked before reaching it is within the radius (the first point
+        past the radius is kept as well)
+    Parameters:
+    distances = the cumulative along-track distance of each point, in time order (param_filter()'s 'Distance')
+        type = numpy.ndarray
+    index_before = the position of the point before the pass
+        type = int
+    index_after = the position of the point after the pass
+        type = int
+    radius = how far to collect up and downstream of the pass, in miles along the track
+        type = float
+    Returns:
+    start = the position of the first point upstream, -1 if the points run out before the window ends
+        type = int
+    end = the position after the last point downstream, len(distances) + 1 if the points run out before the window ends
+        type = int
+    """
+
+    crossing_before = distances[min(index_before + 1, len(distances) - 1)] # Upstream, the first step walked crosses the bridge
+    crossing_after = distances[max(index_after - 1, 0)] # And so does the first step walked downstream
+    start = np.searchsorted(distances, crossing_before - radius, side='left') - 1
+    end = np.searchsorted(distances, crossing_after + radius, side='right') + 1
+    return int(start), int(end)
+
+def pass_window(data, passing, param, radius=5):
+    """
+    pass_window() collects a parameter within a radius upstream and downstream of one bridge pass (see window_bounds() for which
+        points are within it); the window stops at the first or last point of the data
+    Parameters:
+    data = the ship's AIS data around the pass (its day, or the days loaded by VesselTrack), already passed through param_filter()
+        type = pandas.DataFrame
+    passing = one pass, as a row of bridge_reader()'s output
+        type = namedtuple
+    param = the parameter to collect (see param_collection())
+        type = str
+    radius = how far to collect up and downstream of the pass, in miles along the track
+        type = float
+    Returns:
+    collection = the values of the parameter around the pass, from the pass back in time and then from the pass forward in time
+        type = list
+    """
+
+    with stage('window'):
+        # Index is returned as a list, but one ship cannot have 2 AIS data points at the same time, so we take the only index
+        index_before = data.index[data['BaseDateTime'] == passing.time_before][0]
+        index_after = data.index[data['BaseDateTime'] == passing.time_after][0]
+
+        # The cumulative distance only grows with time, so the ends of the window are found with a binary search
+        start, end = window_bounds(data['Distance'].to_numpy(), index_before, index_after, radius)
+        start, end = max(start, 0), min(end, len(data))
+        upstream = data.iloc[start:index_before + 1].iloc[::-1] # Upstream is read "back in time" from the pass
+        downstream = data.iloc[index_after:end]
+
+        collection = []
+        for points in (upstream, downstream):
+            if param != 'Angle Difference':
+                collection += points[param].tolist()
+            elif param == 'Angle Difference':
+                # Calculates angle difference according to rules set out in true_difference() function definition
+                collection += angle_difference(points['COG'], points['Heading']).tolist()
+
+    count('window_points', len(collection))
+    logger.debug("Ship %s from %s to %s: %d %s values upstream, %d downstream", passing.MMSI, passing.time_before, passing.time_after,
+                 len(upstream), param, len(downstream))
+    return collection
+
+def param_collection(path, param, large=False, radius=5):
     """
-    param_collection() takes a csv file (formatted the same way as bridge_reader()'s input) and collects a certain parameter for every bridge pass in the file and ~5 miles up and downstream
+    param_collection() takes a csv file (formatted the same way as bridge_reader()'s input) and collects a certain parameter for every bridge pass in the file and ~5 miles (or radius) up and downstream
     Parameters:
     path = the bridge csv file's path - MUST BE a csv file pre-compiled from our GitHub repo
         type = str
     param = the parameter to collect, must be in ["LAT", "LON", "SOG", "Heading", "COG", "IMO", "Status", "Draft", "Angle Difference"]
         type = str 
+    large = if True, only collects passes of ships at least 150 wide
+        type = bool
+    radius = how far to collect up and downstream of each pass, in miles along the track
+        type = float
     Returns:
     collection = the collection of the parameters in the ~10 mile range up and downstream from the bridge pass
         type = list
+    Passes at midnight, and windows that run past midnight, are collected across both days (see vessel_track.py)
     """
+    from vessel_track import VesselTrack
+
     # Build bridge dataframe 
-    bridge_df = bridge_reader(path)
+    bridge_df = bridge_reader(path, midnight=True)
     if large:
-        bridge_df = bridge_df[bridge_df['Width'].notna()]
-        bridge_df['Width'] = bridge_df['Width'].astype(int)
-        bridge_df = bridge_df[bridge_df['Width'] >= 150]
+        bridge_df = large_passes(bridge_df)
     collection = []
 
-    for passing in bridge_df.itertuples(): # Iterates through the dataframe by row (for each pass)
-
-        # Import data by pass and filter depending on parameter
-        data = Generic_Mask_Filter('data/AIS_' + passing.date + '.csv', MMSI = [str(passing.MMSI)])
-        if param == 'COG':
-            data = data[data['COG'] != 360.0]
-            data['COG'] = [cog + 409.6 if cog < 0 else cog for cog in data['COG']]
-        elif param == 'Heading':
-            data = data[data['Heading'] != 511.0]
-        elif param == 'Angle Difference':
-            data = data[(data['Heading'] != 511.0) & (data['COG'] != 360.0)]
-            data['COG'] = [cog + 409.6 if cog < 0 else cog for cog in data['COG']]
-        elif param == "SOG":
-            data = data[data['SOG'] < 102.3]
-            data['SOG'] = [sog + 102.4 if sog < 0 else sog for sog in data['SOG']]
-        else: 
-            pass
-        data = data.sort_values(by='BaseDateTime')
-        data.reset_index(drop=True, inplace=True)
+    # Passes of the same ship in a row share its track, and the next ship's day is read in the background while the current ship is processed
+    runs = [list(passes) for mmsi, passes in itertools.groupby(bridge_df.itertuples(), key=lambda passing: str(passing.MMSI))]
+    first_day = lambda passes: Generic_Mask_Filter(ais_day_path(passes[0].date), MMSI = [str(passes[0].MMSI)])
 
-        # Upstream loop
-        ind = 0 # For debugging
-        index_before = data.index[data['BaseDateTime'] == passing.time_before][0] # Index is returned as a list, but one ship cannot have 2 AIS data points at the same time, so we take the only index
-        distance_before = 0
-        coordinate_prior = (data['LAT'].tolist()[index_before], data['LON'].tolist()[index_before])
+    for passes, data in prefetch(runs, first_day):
 
-        while distance_before <= 5: # 5 miles upstream
-            # Coordinate variables used to measure the distance between each datapoint as we iterate
-            coordinate = (data['LAT'].tolist()[index_before], data['LON'].tolist()[index_before])
-            coordinate_prior = (data['LAT'].tolist()[index_before + 1], data['LON'].tolist()[index_before + 1])
-            if param != 'Angle Difference':
-                collection.append(data[param].tolist()[index_before])
-            elif param == 'Angle Difference':
-                # Calculates angle difference according to rules set out in true_difference() function definition
-                anglediff = true_difference(pos_angle(data['COG'].tolist()[index_before]), pos_angle(data['Heading'].tolist()[index_before]))
-                collection.append(anglediff)
-            distance_before += distance.distance(coordinate, coordinate_prior).miles # Uses geopy's distance library to find the distance in miles between datapoints and add it to cumulative 
-            print('For index' + str(index_before) + ' on ship' + str(passing.MMSI) + " at time " + data['BaseDateTime'].tolist()[index_before]) # For debugging
-            print("The added " + param + " is " + str(collection[ind])) # For debugging
-            print("And the cumulative distance is " + str(distance_before) + "\n") # For debugging
-            index_before -= 1 # Index decreases since we are moving "back in time"
-            ind += 1 # For debugging
-
-        # Downstream loop
-        index_after = data.index[data['BaseDateTime'] == passing.time_after][0] # Index is returned as a list, but one ship cannot have 2 AIS data points at the same time, so we take the only index
-        distance_after = 0
-        coordinate_prior = (data['LAT'].tolist()[index_after], data['LON'].tolist()[index_after])
-
-        while distance_after <= 5: # 5 miles downstream 
-            coordinate = (data['LAT'].tolist()[index_after], data['LON'].tolist()[index_after])
-            coordinate_prior = (data['LAT'].tolist()[index_after - 1], data['LON'].tolist()[index_after - 1])
-            if param != 'Angle Difference':    
-                collection.append(data['COG'].tolist()[index_after])
-            elif param == 'Angle Difference':
-                # Calculates angle difference according to rules set out in true_difference() function definition
-                anglediff = true_difference(pos_angle(data['COG'].tolist()[index_after]), pos_angle(data['Heading'].tolist()[index_after]))
-                collection.append(anglediff)
-            distance_after += distance.distance(coordinate, coordinate_prior).miles # Uses geopy's distance library to find the distance in miles between datapoints and add it to cumulative 
-            print('For index ' + str(index_after) + ' on ship ' + str(passing.MMSI) + " at time " + data['BaseDateTime'].tolist()[index_after]) # For debugging
-            print("The added " + param + " is " + str(collection[ind])) # For debugging
-            print("And the cumulative distance is " + str(distance_after) + "\n") # For debugging
-            index_after += 1 # Index increases since we are now moving forward in time
-            ind += 1 # For debugging
-
-        print(str(passing.Index + 1) + "/" + str(len(bridge_df)) + " through the pass data.") # For debugging
+        # Import the ship's data around each pass, loading the days next to it only if the window reaches them
+        track = VesselTrack(passes[0].MMSI, days={passes[0].date: data})
+        for passing in passes: # Iterates through the dataframe by row (for each pass)
+            collection += track.collect(passing, param, radius)
+
+            logger.info("%d/%d through the pass data.", passing.Index + 1, len(bridge_df))
     
     return collection
+
+def param_collection_batch(path, params, large=False, radius=5, chunksize=None):
+    """
+    param_collection_batch() collects the same parameters as param_collection(), but loads each day's AIS data only once for all of the passes on that day
+        and collects several parameters in the same pass through the data
+    Parameters:
+    path = the bridge csv file's path - MUST BE a csv file pre-compiled from our GitHub repo
+        type = str
+    params = the parameters to collect, each must be in ["LAT", "LON", "SOG", "Heading", "COG", "IMO", "Status", "Draft", "Angle Difference"]
+        type = list
+    large = if True, only collects passes of ships at least 150 wide
+        type = bool
+    radius = how far to collect up and downstream of each pass, in miles along the track
+        type = float
+    chunksize = if given, the bridge file is read this many rows at a time with bridge_reader_chunks()
+        type = int
+    Returns:
+    collections = for each parameter, the same collection param_collection() returns, in the same order
+        type = dict
+    """
+    from vessel_track import VesselTrack, shared_day_loader
+
+    # Build bridge dataframe(s)
+    bridge_dfs = bridge_reader_chunks(path, chunksize, midnight=True) if chunksize else [bridge_reader(path, midnight=True)]
+    collections = {param: [] for param in params}
+
+    for bridge_df in bridge_dfs:
+        if large:
+            bridge_df = large_passes(bridge_df)
+        windows = {} # The collections of each pass, keyed by the pass's index in bridge_df
+
+        # Import each day's data once for every ship that passes on that day, reading the next day in the background
+        days = bridge_df.groupby('date', sort=False)
+        read_day = lambda day: Generic_Mask_Filter(ais_day_path(day[0]), MMSI = sorted(set(str(mmsi) for mmsi in day[1]['MMSI'])))
+
+        for (date, day_passes), data in prefetch(days, read_day):
+
+            # Split the day into one track per ship
+            mmsis = sorted(set(str(mmsi) for mmsi in day_passes['MMSI']))
+            tracks = {str(mmsi): track for mmsi, track in data.groupby('MMSI', observed=True)}
+
+            # Each ship's track keeps its data filtered for each parameter, shared by its passes, and reads the days next to it
+            # (once for all of the day's ships) only if a window reaches them
+            loader = shared_day_loader(mmsis)
+            vessels = {mmsi: VesselTrack(mmsi, loader=loader, days={date: tracks.get(mmsi, data.iloc[0:0])}) for mmsi in mmsis}
+
+            for passing in day_passes.itertuples():
+                windows[passing.Index] = {}
+                for param in params:
+                    windows[passing.Index][param] = vessels[str(passing.MMSI)].collect(passing, param, radius)
+
+            logger.info("%d/%d through the pass data.", len(windows), len(bridge_df))
+
+        # Join the windows in the order of the bridge file
+        for param in params:
+            collections[param] += [value for index in bridge_df.index for value in windows[index][param]]
+
+    return collections
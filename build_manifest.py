@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+from ais_store import store_path
+from tools import ais_day_path
+
+# The build manifest records what each incident's outputs were made from, so only the incidents whose inputs changed are rendered again
+MANIFEST_PATH = 'data/build_manifest.json'
+CODE_FILES = ['tools.py', 'arcgis_datagen.py', 'cleaned_ship_graphing.py', 'incident_runner.py'] # The code the outputs depend on
+
+def file_digest(path):
+    """
+    file_digest() gives the SHA-1 of a file's contents, read a block at a time
+    Parameters:
+    path = the file's path
+        type = str
+    Returns:
+    the hexadecimal digest
+        type = str
+    """
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def code_version():
+    """
+    code_version() identifies the version of the code the outputs depend on by the contents of CODE_FILES
+    Returns:
+    the SHA-1 of the files' digests
+        type = str
+    """
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    return hashlib.sha1(''.join(file_digest(os.path.join(folder, name)) for name in CODE_FILES).encode()).hexdigest()
+
+def source_file(date):
+    """
+    source_file() gives the file a day's AIS data is read from: its csv (or zip) file, or its columnar store once that file is deleted
+    Parameters:
+    date = the day, in YYYY_MM_DD format
+        type = str
+    Returns:
+    the path, or None if the day has neither
+        type = str
+    """
+
+    path = ais_day_path(date)
+    for candidate in (path, store_path(path)):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+def source_identity(path, previous=None):
+    """
+    source_identity() describes a source file by its path, size, modification time and contents
+        The contents are only hashed when the size or modification time differ from the previous identity, so checking an unchanged
+        day costs a stat, and a day file that was copied or touched without changing is still recognised
+    Parameters:
+    path = the source file's path, or None if it is missing
+        type = str
+    previous = the identity recorded the last time, if any
+        type = dict
+    Returns:
+    the path, size, modification time in nanoseconds and SHA-1, or None if the file is missing
+        type = dict
+    """
+
+    if path is None:
+        return None
+    stat = os.stat(path)
+    identity = {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if previous and all(previous.get(key) == value for key, value in identity.items()):
+        identity['sha1'] = previous['sha1']
+    else:
+        identity['sha1'] = file_digest(path)
+    return identity
+
+def load_manifest(path=MANIFEST_PATH):
+    """
+    load_manifest() reads the build manifest
+    Parameters:
+    path = the manifest's path
+        type = str
+    Returns:
+    manifest = the record of each output group, keyed by the group's name, empty if there is no manifest yet
+        type = dict
+    """
+
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(manifest, path=MANIFEST_PATH):
+    """
+    save_manifest() writes the build manifest, replacing the old one only once the new one is written
+    Parameters:
+    manifest = the record of each output group
+        type = dict
+    path = the manifest's path
+        type = str
+    Returns:
+    None
+    """
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def build_inputs(source, MMSI, params, code):
+    """
+    build_inputs() describes everything an output group depends on
+    Parameters:
+    source = the identity of the AIS data's source file, as returned by source_identity()
+        type = dict
+    MMSI = the ship's MMSI
+        type = str
+    params = everything else the outputs are made from, ex: the incident's title and time
+        type = dict
+    code = the version of the code, as returned by code_version()
+        type = str
+    Returns:
+    the inputs
+        type = dict
+    """
+
+    return {'source': source, 'MMSI': str(MMSI), 'params': params, 'code': code}
+
+def stale_reason(record, inputs, outputs):
+    """
+    stale_reason() checks whether an output group must be made again
+    Parameters:
+    record = the group's record in the manifest, or None if it was never made
+        type = dict
+    inputs = the group's current inputs, as returned by build_inputs()
+        type = dict
+    outputs = the paths of the group's outputs
+        type = dict
+    Returns:
+    the reason the group is stale, ex: 'source changed', or None if it is up to date
+        type = str
+    """
+
+    if record is None:
+        return 'new'
+    if inputs['source'] is None:
+        return 'source missing'
+    previous = record['inputs']
+    if previous.get('source') is None or previous['source']['sha1'] != inputs['source']['sha1']:
+        return 'source changed'
+    if previous.get('MMSI') != inputs['MMSI'] or previous.get('params') != inputs['params']:
+        return 'parameters changed'
+    if previous.get('code') != inputs['code']:
+        return 'code changed'
+    if record.get('outputs') != outputs or not all(os.path.exists(path) for path in outputs.values()):
+        return 'output missing'
+    return None
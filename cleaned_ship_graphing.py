@@ -1,12 +1,125 @@
+import logging
 import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
-from tools import Generic_Mask_Filter, pos_angle, true_difference
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from instrumentation import stage
+from tools import Generic_Mask_Filter, ais_day_path, angle_difference, fractional_hours, normalize_sentinels
+
+logger = logging.getLogger(__name__)
+
+# Limits that keep the cost of a plot independent of the length of the track (see render_standard_plots())
+MAX_POINTS = 2000 # Points drawn in a scatter, picked with lttb()
+MAX_BINS = 100 # Bins of a histogram
+KDE_SAMPLE = 5000 # Values the kernel density estimate is fitted to
+
+def lttb(x, y, threshold):
+    """
+    lttb() picks the points that best preserve the shape of a series, with the Largest-Triangle-Three-Buckets method:
+        the first and last points are kept, and the rest of the series is split into equal buckets, keeping from each bucket the point that
+        makes the largest triangle with the point kept from the previous bucket and the average of the next bucket
+    Parameters:
+    x = the x values, sorted
+        type = numpy.ndarray or pandas.Series
+    y = the y values
+        type = numpy.ndarray or pandas.Series
+    threshold = the number of points to keep
+        type = int
+    Returns:
+    keep = the positions of the points kept, in order (every position if there are no more points than threshold)
+        type = numpy.ndarray
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if threshold >= len(x) or threshold < 3:
+        return np.arange(len(x))
+
+    edges = np.linspace(1, len(x) - 1, threshold - 1).astype(np.int64) # threshold - 2 buckets between the first and last points
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0], keep[-1] = 0, len(x) - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        following = slice(end, edges[i + 2] if i + 2 < len(edges) else len(x))
+        mean_x, mean_y = x[following].mean(), y[following].mean()
+        area = np.abs((x[previous] - mean_x) * (y[start:end] - y[previous]) - (x[previous] - x[start:end]) * (mean_y - y[previous]))
+        previous = start + int(np.argmax(area))
+        keep[i + 1] = previous
+    return keep
+
+def decimate(df, x, y, max_points):
+    """
+    decimate() keeps at most max_points rows of a dataframe to scatter, sorted by x and picked with lttb()
+    Parameters:
+    df = the points
+        type = pandas.DataFrame
+    x = the column of the x values
+        type = str
+    y = the column of the y values
+        type = str
+    max_points = the most rows to keep, or None to keep every row
+        type = int
+    Returns:
+    df = the rows kept
+        type = pandas.DataFrame
+    """
+
+    if max_points is None or len(df) <= max_points:
+        return df
+    df = df.sort_values(x)
+    return df.iloc[lttb(df[x], df[y], max_points)]
+
+def render_standard_plots(data, MMSI, outputs, title='', max_points=MAX_POINTS, max_bins=MAX_BINS, kde_sample=KDE_SAMPLE):
+    """
+    render_standard_plots() writes the four standard angle difference plots of one ship to files, from one preprocessed copy of its data,
+        with a cost that does not grow with the length of the track
+        Each plot is drawn on its own matplotlib Figure, outside pyplot, and written with the headless Agg renderer; pyplot's backend
+        and any figures the caller has open (ex: in a notebook) are left as they are
+    Parameters:
+    data = the ship's AIS data, as returned by Generic_Mask_Filter()
+        type = pandas.DataFrame
+    MMSI = the ship's MMSI
+        type = str
+    outputs = the path of each plot, keyed by 'scatter', 'scatter_change', 'hist' and 'hist_change'
+        type = dict
+    title = the start of each plot's title, ex: 'ZEUS, Allision - 10/14/2019'
+        type = str
+    max_points = the most points of each series in the scatters (see incident_graph())
+        type = int
+    max_bins = the most bins of the histograms (see param_hist())
+        type = int
+    kde_sample = the most values the kernel density estimates are fitted to (see param_hist())
+        type = int
+    Returns:
+    None
+    """
+
+    # Normalise and sort the data once for the four plots
+    data = normalize_sentinels(data).sort_values('BaseDateTime')
+
+    plots = [('scatter', ' (Angle Difference)', lambda ax: incident_graph(None, MMSI, data=data, max_points=max_points, ax=ax)),
+             ('scatter_change', ' (Change in Angle Difference)', lambda ax: change_graph(None, MMSI, 'Difference', data=data,
+                                                                                        max_points=max_points, ax=ax)),
+             ('hist', ' (Angle Difference)', lambda ax: param_hist(None, MMSI, 'Angle Difference', data=data, max_bins=max_bins,
+                                                                  kde_sample=kde_sample, ax=ax)),
+             ('hist_change', ' (Change in Angle Difference)', lambda ax: param_hist(None, MMSI, 'Angle Difference', change=True, data=data,
+                                                                                   max_bins=max_bins, kde_sample=kde_sample, ax=ax))]
+
+    for output, suffix, plot in plots:
+        fig = Figure()
+        FigureCanvasAgg(fig) # Render to files only, whatever pyplot's backend is
+        ax = fig.subplots()
+        plot(ax)
+        with stage('plot'):
+            ax.set_title(title + suffix)
+            fig.savefig(outputs[output])
 
 # Code written by Lemon Doroshow
-def incident_graph(path, MMSI):
+def incident_graph(path, MMSI, data=None, max_points=None, ax=None):
     """
     incident_graph() shows a graph of a day's worth of AIS data for one ship
     Parameters:
@@ -18,53 +131,57 @@ def incident_graph(path, MMSI):
         type = string, format 'HH:MM:SS'
     plot_togeter = Whether to plot the lat-lon colormap and the statuses as well as the angle difference, False by default
         type = Boolean
+    data = the ship's AIS data if it was already imported with Generic_Mask_Filter(), so the day's file is not read again
+        type = pandas.DataFrame
+    max_points = the most points of each series to draw, picked with lttb() so the shape of the track is kept; every point by default
+        type = int
+    ax = the axes to draw on, a new figure by default
+        type = matplotlib.axes.Axes
     Returns:
     matplotlib figure to be called with plt.show() or plt.savefig()
     """
 
     # Import data into a dataframe, filtering for MMSI; removing Heading = 511.0 and adjusting COG according to https://coast.noaa.gov/data/marinecadastre/ais/faq.pdf
-    data = Generic_Mask_Filter(("data/AIS_" + path + '.csv'), MMSI=[MMSI])
-    data_511 = data[(data['Heading'] == 511.0) | (data['COG'] == 360.0)]
-    data = data[(data['Heading'] != 511.0) & (data['COG'] != 360.0)]
-    data['COG'] = [cog + 409.6 if cog < 0 else cog for cog in data['COG']]
-
-    # Adjust times and dates to fit YYYY-MM-DD and HH:MM:SS
-    times_raw = pd.to_datetime([strings for strings in data["BaseDateTime"]]).time
-    hours = [t.hour for t in times_raw]
-    minutes = [t.minute for t in times_raw]
-    seconds = [t.second for t in times_raw]
-    times_adjusted = [h + m/60 + s/3600 for h, m, s in zip(hours, minutes, seconds)]
-    times_raw_511 = pd.to_datetime([strings for strings in data_511["BaseDateTime"]]).time
-    hours_511 = [t.hour for t in times_raw_511]
-    minutes_511 = [t.minute for t in times_raw_511]
-    seconds_511 = [t.second for t in times_raw_511]
-    times_adjusted_511 = [h + m/60 + s/3600 for h, m, s in zip(hours_511, minutes_511, seconds_511)]
+    if data is None:
+        data = Generic_Mask_Filter(ais_day_path(path), MMSI=[MMSI])
+    data = normalize_sentinels(data)
+    data_511 = data[data['Heading'].isna() | data['COG'].isna()]
+    data = data.dropna(subset=['Heading', 'COG'])
+
+    # Adjust times to hours of the day
+    times_adjusted = fractional_hours(data['BaseDateTime'])
+    times_adjusted_511 = fractional_hours(data_511['BaseDateTime'])
 
     # Extract status and angle difference data  
     statuses = data['Status']
-    angle_difference = [true_difference(pos_angle(cog), pos_angle(heading)) for cog, heading in zip(data['COG'], data['Heading'].astype(np.float64))]
+    angle_diffs = angle_difference(data['COG'], data['Heading'])
 
     # Define dataframe containing times, statuses, and angle differences
-    mapped_data = {'time':times_adjusted, 'status': statuses, 'angle_difference':angle_difference, 'true_times':[a.hour+a.minute/60 for a in times_raw]}
+    mapped_data = {'time':times_adjusted, 'status': statuses, 'angle_difference':angle_diffs, 'true_times':data['BaseDateTime'].dt.hour + data['BaseDateTime'].dt.minute/60}
     mapped_data_511 = {'time':times_adjusted_511, 'angle_difference':[0] * len(data_511['Heading'].tolist())}
     mapped_df = pd.DataFrame(mapped_data)
     mapped_df_511 = pd.DataFrame(mapped_data_511)
+    mapped_df = decimate(mapped_df, 'time', 'angle_difference', max_points)
+    mapped_df_511 = decimate(mapped_df_511, 'time', 'angle_difference', max_points)
 
-    # Set up figure and axes
-    fig, ax = plt.subplots()
-    
-    # Labelling status and angle difference graphs
-    ax.xaxis.set_major_locator(ticker.LinearLocator(8))
-    ax.tick_params(axis='x',labelrotation=45)
-    ax.set_xlabel('Time (UTC)')
-    ax.set_ylabel('Angle Difference (deg)')
-
-    # Create scatter plots with vertical line at incident time
-    ax.scatter(mapped_df['time'], mapped_df['angle_difference'])
-    ax.scatter(mapped_df_511['time'], mapped_df_511['angle_difference'], color='red')
-    fig.tight_layout()
-
-def change_graph(path, MMSI, measurement):
+    logger.debug("Plotting %d angle differences of ship %s, %d points without one", len(mapped_df), MMSI, len(mapped_df_511))
+    with stage('plot'):
+        # Set up figure and axes
+        if ax is None:
+            fig, ax = plt.subplots()
+
+        # Labelling status and angle difference graphs
+        ax.xaxis.set_major_locator(ticker.LinearLocator(8))
+        ax.tick_params(axis='x',labelrotation=45)
+        ax.set_xlabel('Time (UTC)')
+        ax.set_ylabel('Angle Difference (deg)')
+
+        # Create scatter plots with vertical line at incident time
+        ax.scatter(mapped_df['time'], mapped_df['angle_difference'])
+        ax.scatter(mapped_df_511['time'], mapped_df_511['angle_difference'], color='red')
+        ax.figure.tight_layout()
+
+def change_graph(path, MMSI, measurement, data=None, max_points=None, ax=None):
     """
     change_graph() shows a plot of the change in a certain variable of a ship's movement at each broadcast point
     Parameters:
@@ -74,97 +191,61 @@ def change_graph(path, MMSI, measurement):
         type = str (returns an empty dataframe if MMSI is entered as an int or float)
     measurement = which variable to plot the change of
         type = string, either 'COG', 'Heading', or 'Difference' (case sensitive)
+    data = the ship's AIS data if it was already imported with Generic_Mask_Filter(), so the day's file is not read again
+        type = pandas.DataFrame
+    max_points = the most points to draw, picked with lttb() so the shape of the changes is kept; every point by default
+        type = int
+    ax = the axes to draw on, a new figure by default
+        type = matplotlib.axes.Axes
     Returns:
     matplotlib figure to be called with plt.show() or plt.savefig()
     """
 
-    # Import AIS data
-    data = Generic_Mask_Filter(("data/AIS_" + path + '.csv'), MMSI=[MMSI])
-
-    # Adjust AIS data times
-    times_raw = pd.to_datetime([strings for strings in data["BaseDateTime"]]).time
-    hours = [t.hour for t in times_raw]
-    minutes = [t.minute for t in times_raw]
-    seconds = [t.second for t in times_raw]
-    times_adjusted = [h + m/60 + s/3600 for h, m, s in zip(hours, minutes, seconds)]
-
-    # Set up subplots
-    fig, ax = plt.subplots()
+    # Import AIS data, with unavailable courses and headings as NaN
+    if data is None:
+        data = Generic_Mask_Filter(ais_day_path(path), MMSI=[MMSI])
+    data = normalize_sentinels(data)
 
-    # Format axes
-    ax.xaxis.set_major_locator(ticker.LinearLocator(8))
-    ax.tick_params(axis='x',labelrotation=45)
-    ax.set_xlabel('Time (UTC)')
-
-    # Heading DF construction
+    # Keep the points where the chosen measurement is available
     if measurement == "Heading":
-
-        # Remove null values and create sorted DF
-        data = data[data['Heading'] != 511.0]
-        mapped_data = {'time':times_adjusted, 'Heading':data['Heading']}
-        mapped_df = pd.DataFrame(mapped_data)
-        mapped_df = mapped_df.sort_values('time')
-        headings = mapped_df['Heading'].tolist()
-
-        # Create a new dataframe with the change in heading calculated at each point - the initial point is equal to zero
-        change = [0]
-        i = 1
-        while i < len(headings):
-            change.append(headings[i] - headings[i-1])
-            i += 1
-        mapped_data = {'time':times_adjusted, 'change':change}
-        mapped_df = pd.DataFrame(mapped_data)
-        ax.set_ylabel('Change in Heading (deg)')
-
-    # COG DF construction
+        data = data.dropna(subset=['Heading'])
+        values = data['Heading'].astype(np.float64)
+        label = 'Change in Heading (deg)'
     elif measurement == 'COG':
-
-        # Create sorted DF
-        data = data[data['COG'] != 360.0]
-        mapped_data = {'time':times_adjusted, 'COG':data['COG']}
-        mapped_df = pd.DataFrame(mapped_data)
-        mapped_df = mapped_df.sort_values('time')
-        cogs = mapped_df['COG'].tolist()
-
-        # Create a new dataframe with the change in COG calculated at each point - initial is equal to zero
-        change = [0]
-        i = 1
-        while i < len(cogs):
-            change.append(cogs[i] - cogs[i-1])
-            i += 1
-        mapped_data = {'time':times_adjusted, 'change':change}
-        mapped_df = pd.DataFrame(mapped_data)
-        ax.set_ylabel('Change in COG (deg)')
-
-    # Angle difference DF construction
+        data = data.dropna(subset=['COG'])
+        values = data['COG']
+        label = 'Change in COG (deg)'
     elif measurement == 'Difference':
-
-        # Calculate angle differences and create sorted dataframe
-        data = data[(data['Heading'] != 511.0) & (data['COG'] != 360.0)]
-        angle_difference = [true_difference(pos_angle(cog), pos_angle(heading)) for cog, heading in zip(data['COG'], data['Heading'].astype(np.float64))]
-        mapped_data = {'time':times_adjusted, 'difference':angle_difference}
-        mapped_df = pd.DataFrame(mapped_data)
-        mapped_df = mapped_df.sort_values('time')
-        diffs = mapped_df['difference'].tolist()
-
-        # Create new dataframe with the change in angle difference at each point - initial is equal to zero
-        change = [0]
-        i = 1
-        while i < len(diffs):
-            change.append(diffs[i] - diffs[i-1])
-            i += 1
-        mapped_data = {'time':times_adjusted, 'change':change}
-        mapped_df = pd.DataFrame(mapped_data)
-        ax.set_ylabel('Change in Angle Difference (deg)')
+        data = data.dropna(subset=['Heading', 'COG'])
+        values = angle_difference(data['COG'], data['Heading'])
+        label = 'Change in Angle Difference (deg)'
 
     # Raise an exception if the measurements argument is formatted incorrectly
     else:
         raise Exception("Please choose COG, Heading, or Difference! (case sensitive)")
-    
-    # Plot scatterplot of chosen changes along with a vertical line at the time of incident
-    ax.scatter(mapped_df['time'], mapped_df['change'])
 
-def param_hist(path, MMSI, param, change=False, kde=True):
+    # Create a dataframe sorted by time with the change calculated at each point - the initial point is equal to zero
+    mapped_df = pd.DataFrame({'time':fractional_hours(data['BaseDateTime']), 'value':values, 'order':data['BaseDateTime']})
+    mapped_df = mapped_df.sort_values('order')
+    mapped_df['change'] = mapped_df['value'].diff().fillna(0)
+    mapped_df = decimate(mapped_df, 'time', 'change', max_points)
+
+    logger.debug("Plotting %d changes in %s of ship %s", len(mapped_df), measurement, MMSI)
+    with stage('plot'):
+        # Set up subplots
+        if ax is None:
+            fig, ax = plt.subplots()
+
+        # Format axes
+        ax.xaxis.set_major_locator(ticker.LinearLocator(8))
+        ax.tick_params(axis='x',labelrotation=45)
+        ax.set_xlabel('Time (UTC)')
+        ax.set_ylabel(label)
+
+        # Plot scatterplot of chosen changes along with a vertical line at the time of incident
+        ax.scatter(mapped_df['time'], mapped_df['change'])
+
+def param_hist(path, MMSI, param, change=False, kde=True, data=None, max_bins=None, kde_sample=None, ax=None):
     """
     param_hist() creates a histogram of a ship's given parameter (or change in that parameter at every AIS broadcast point) over the course of a day
     Parameters:
@@ -178,56 +259,60 @@ def param_hist(path, MMSI, param, change=False, kde=True):
         type = bool
     kde = if True, plots a kernel density estimate along with the histogram
         type = bool
+    data = the ship's AIS data if it was already imported with Generic_Mask_Filter(), so the day's file is not read again
+        type = pandas.DataFrame
+    max_bins = the most bins of the histogram, which otherwise has one bin per 10 values
+        type = int
+    kde_sample = the most values to fit the kernel density estimate to, picked at random (the same ones every time); every value by default
+        type = int
+    ax = the axes to draw on, the current axes by default
+        type = matplotlib.axes.Axes
     Returns:
     matplotlib figure to be called with plt.show() or plt.savefig()
     """
 
     # Import data and filter
-    data = Generic_Mask_Filter('data/AIS_' + path + '.csv', MMSI = [MMSI])
-    if param == 'COG':
-        data = data[data['COG'] != 360.0]
-        data['COG'] = [cog + 409.6 if cog < 0 else cog for cog in data['COG']]
-    elif param == 'Heading':
-        data = data[data['Heading'] != 511.0]
+    if data is None:
+        data = Generic_Mask_Filter(ais_day_path(path), MMSI = [MMSI])
+    data = normalize_sentinels(data)
+    if param in ['COG', 'Heading', 'SOG']:
+        data = data.dropna(subset=[param])
     elif param == 'Angle Difference':
-        data = data[(data['Heading'] != 511.0) & (data['COG'] != 360.0)]
-        data['COG'] = [cog + 409.6 if cog < 0 else cog for cog in data['COG']]
-    elif param == "SOG":
-        data = data[data['SOG'] < 102.3]
-        data['SOG'] = [sog + 102.4 if sog < 0 else sog for sog in data['SOG']]
+        data = data.dropna(subset=['COG', 'Heading'])
     else: 
         pass
     data = data.sort_values(by='BaseDateTime')
     data.reset_index(drop=True, inplace=True)
 
     # Collect data in list depending on parameter and whether or not change = True
-    if change:
-        if param == 'Angle Difference':
-            precol = [true_difference(pos_angle(cog), pos_angle(Heading)) for cog, Heading in zip(data['COG'].tolist(), data['Heading'].tolist())]
-        else:
-            precol = data[param].tolist()
-        collection = [0]
-        i = 1
-        while i < len(precol):
-            collection.append(precol[i] - precol[i-1])
-            i += 1
+    if param == 'Angle Difference':
+        collection = angle_difference(data['COG'], data['Heading'])
     else:
-        if param == 'Angle Difference':
-            collection = [true_difference(pos_angle(cog), pos_angle(Heading)) for cog, Heading in zip(data['COG'].tolist(), data['Heading'].tolist())]
-        else:
-            collection = data[param].tolist()
+        collection = data[param]
+    if change:
+        collection = collection.diff()
+        collection.iloc[:1] = 0 # The initial point has a change of zero; changes from missing values stay missing and are not plotted
+    collection = collection.tolist()
     
-    # Plot the histogram and kde, if applicable
-    sns.histplot(x=collection, stat='density', bins = int(len(collection) / 10), color="royalblue")
-    if kde:    
-        sns.kdeplot(x=collection, color='black')
-    if param in ["LAT", "LON", "Heading", "COG", "Angle Difference"]:
-        unit = ' (deg)'
-    elif param == 'Draft':
-        unit = ' (meters)'
-    elif param == 'SOG':
-        unit = ' (knots)'
-    elif param == 'Status':
-        unit = ''
-    plt.xlabel(param + unit)
-    plt.ylabel('Density')
\ No newline at end of file
+    logger.debug("Plotting a histogram of %d %s values of ship %s", len(collection), param, MMSI)
+    with stage('plot'):
+        # Plot the histogram and kde, if applicable
+        if ax is None:
+            ax = plt.gca()
+        bins = max(int(len(collection) / 10), 1)
+        sns.histplot(x=collection, stat='density', bins = min(bins, max_bins) if max_bins else bins, color="royalblue", ax=ax)
+        if kde:    
+            sample = collection
+            if kde_sample and len(collection) > kde_sample:
+                sample = np.random.default_rng(0).choice(collection, size=kde_sample, replace=False)
+            sns.kdeplot(x=sample, color='black', ax=ax)
+        if param in ["LAT", "LON", "Heading", "COG", "Angle Difference"]:
+            unit = ' (deg)'
+        elif param == 'Draft':
+            unit = ' (meters)'
+        elif param == 'SOG':
+            unit = ' (knots)'
+        elif param == 'Status':
+            unit = ''
+        ax.set_xlabel(param + unit)
+        ax.set_ylabel('Density')
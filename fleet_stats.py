@@ -0,0 +1,328 @@
+import argparse
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from instrumentation import count, stage
+from tools import Generic_Mask_Filter, ais_day_path, angle_difference, normalize_sentinels
+
+logger = logging.getLogger(__name__)
+
+# Per-vessel statistics of a whole fleet, built from each day file in one pass. Every statistic is a sum, a minimum, a maximum or a
+# histogram with fixed bins, so the statistics of different days (or of different processes) are merged by adding them up. The
+# statistics record the days they are of, and a day is never merged into statistics that already include it.
+STATS_PATH = 'data/fleet_stats.npz'
+
+# The fixed bins of each parameter's values and of its changes between consecutive broadcasts: (lowest, highest, width)
+# Values outside the bins are counted in the first or last bin
+BINS = {'SOG': ((0, 40, 0.5), (-20, 20, 0.5)),
+        'COG': ((0, 360, 5), (-360, 360, 10)),
+        'Heading': ((0, 360, 5), (-360, 360, 10)),
+        'Angle Difference': ((-180, 180, 2), (-360, 360, 5))}
+FIELDS = ['n', 'sum', 'sumsq', 'min', 'max', 'hist', 'change_n', 'change_sum', 'change_sumsq', 'change_hist']
+
+def bin_edges(param, change=False):
+    """
+    bin_edges() gives the edges of the fixed bins of a parameter's histogram
+    Parameters:
+    param = the parameter, one of BINS
+        type = str
+    change = if True, the bins of the changes between consecutive broadcasts instead of the values
+        type = bool
+    Returns:
+    the edges, one more than the bins
+        type = numpy.ndarray
+    """
+
+    low, high, width = BINS[param][1 if change else 0]
+    return np.linspace(low, high, int(round((high - low) / width)) + 1)
+
+def empty_stats(mmsis, dates=()):
+    """
+    empty_stats() creates the statistics of a set of vessels without any broadcasts
+    Parameters:
+    mmsis = the MMSIs, sorted
+        type = numpy.ndarray
+    dates = the days the statistics are of, in YYYY_MM_DD format
+        type = list
+    Returns:
+    stats = the MMSIs, the sorted days, and for each parameter of BINS the arrays of FIELDS, one row per MMSI
+        type = dict
+    """
+
+    stats = {'mmsis': np.asarray(mmsis, dtype=str), 'dates': np.asarray(sorted(dates), dtype=str)}
+    for param in BINS:
+        stats[param] = {'n': np.zeros(len(mmsis), dtype=np.int64), 'sum': np.zeros(len(mmsis)), 'sumsq': np.zeros(len(mmsis)),
+                        'min': np.full(len(mmsis), np.nan), 'max': np.full(len(mmsis), np.nan),
+                        'hist': np.zeros((len(mmsis), len(bin_edges(param)) - 1), dtype=np.int64),
+                        'change_n': np.zeros(len(mmsis), dtype=np.int64), 'change_sum': np.zeros(len(mmsis)),
+                        'change_sumsq': np.zeros(len(mmsis)),
+                        'change_hist': np.zeros((len(mmsis), len(bin_edges(param, True)) - 1), dtype=np.int64)}
+    return stats
+
+def histogram_rows(rows, values, edges, vessels):
+    """
+    histogram_rows() counts values into fixed bins, with one histogram per vessel, all at once
+    Parameters:
+    rows = the vessel (row of the statistics) of each value
+        type = numpy.ndarray
+    values = the values
+        type = numpy.ndarray
+    edges = the edges of the bins
+        type = numpy.ndarray
+    vessels = the number of vessels
+        type = int
+    Returns:
+    the counts, one row per vessel and one column per bin
+        type = numpy.ndarray
+    """
+
+    bins = len(edges) - 1
+    columns = np.clip(((values - edges[0]) / (edges[1] - edges[0])).astype(np.int64), 0, bins - 1)
+    return np.bincount(rows * bins + columns, minlength=vessels * bins).reshape(vessels, bins)
+
+def day_stats(file_path, date=None):
+    """
+    day_stats() computes the statistics of every vessel in a day of AIS data, reading the file once
+    Parameters:
+    file_path = the path of the AIS csv (or zip) file
+        type = str
+    date = the day, in YYYY_MM_DD format, recorded so that it is not merged twice; by default the date in the file's name
+        type = str
+    Returns:
+    stats = the statistics of the day's vessels (see empty_stats())
+        type = dict
+    """
+
+    if date is None:
+        date = re.search(r'\d{4}_\d{2}_\d{2}', os.path.basename(file_path))
+        if date is None:
+            raise Exception("There is no YYYY_MM_DD date in the name of " + file_path + "!")
+        date = date.group()
+    data = Generic_Mask_Filter(file_path, columns=['MMSI', 'BaseDateTime', 'SOG', 'COG', 'Heading'], cache=False)
+    data = normalize_sentinels(data.dropna(subset=['MMSI']))
+
+    with stage('fleet'):
+        # Order every vessel's broadcasts by time; rows are the vessels' positions in the sorted MMSIs
+        mmsis, rows = np.unique(data['MMSI'].astype(str).to_numpy(), return_inverse=True)
+        order = np.lexsort((data['BaseDateTime'].to_numpy(), rows))
+        rows = rows[order]
+        columns = {'SOG': data['SOG'].to_numpy(dtype=np.float64, na_value=np.nan)[order],
+                   'COG': data['COG'].to_numpy(dtype=np.float64, na_value=np.nan)[order],
+                   'Heading': data['Heading'].to_numpy(dtype=np.float64, na_value=np.nan)[order]}
+        columns['Angle Difference'] = np.asarray(angle_difference(columns['COG'], columns['Heading']), dtype=np.float64)
+
+        stats = empty_stats(mmsis, [date])
+        for param, values in columns.items():
+            # Keep the broadcasts where the parameter is available, still grouped by vessel and in time order
+            available = ~np.isnan(values)
+            vessel, values = rows[available], values[available]
+            accumulators = stats[param]
+            accumulators['n'] = np.bincount(vessel, minlength=len(mmsis))
+            accumulators['sum'] = np.bincount(vessel, values, minlength=len(mmsis))
+            accumulators['sumsq'] = np.bincount(vessel, values ** 2, minlength=len(mmsis))
+            accumulators['hist'] = histogram_rows(vessel, values, bin_edges(param), len(mmsis))
+            if len(values):
+                starts = np.flatnonzero(np.r_[True, vessel[1:] != vessel[:-1]])
+                accumulators['min'][vessel[starts]] = np.minimum.reduceat(values, starts)
+                accumulators['max'][vessel[starts]] = np.maximum.reduceat(values, starts)
+
+            # Changes between consecutive available broadcasts of the same vessel, as in param_hist(change=True)
+            same = vessel[1:] == vessel[:-1]
+            vessel, changes = vessel[1:][same], np.diff(values)[same]
+            accumulators['change_n'] = np.bincount(vessel, minlength=len(mmsis))
+            accumulators['change_sum'] = np.bincount(vessel, changes, minlength=len(mmsis))
+            accumulators['change_sumsq'] = np.bincount(vessel, changes ** 2, minlength=len(mmsis))
+            accumulators['change_hist'] = histogram_rows(vessel, changes, bin_edges(param, True), len(mmsis))
+
+    count('fleet_vessels', len(mmsis))
+    logger.info("%d vessels in %s", len(mmsis), file_path)
+    return stats
+
+def merge_stats(first, second):
+    """
+    merge_stats() merges the statistics of two sets of broadcasts, ex: of two days, or of two processes
+    Parameters:
+    first = the statistics of the first set (see empty_stats())
+        type = dict
+    second = the statistics of the second set
+        type = dict
+    Returns:
+    stats = the statistics of both sets together, over the union of their vessels and days
+        type = dict
+    Raises an exception if both sets include a day, since its broadcasts would be counted twice
+    """
+
+    repeated = np.intersect1d(first['dates'], second['dates'])
+    if len(repeated):
+        raise Exception("The statistics of " + ', '.join(repeated) + " are already included!")
+    stats = empty_stats(np.union1d(first['mmsis'], second['mmsis']), np.union1d(first['dates'], second['dates']))
+    for part in (first, second):
+        rows = np.searchsorted(stats['mmsis'], part['mmsis'])
+        for param in BINS:
+            for field in FIELDS:
+                if field == 'min':
+                    stats[param][field][rows] = np.fmin(stats[param][field][rows], part[param][field])
+                elif field == 'max':
+                    stats[param][field][rows] = np.fmax(stats[param][field][rows], part[param][field])
+                else:
+                    stats[param][field][rows] += part[param][field]
+    return stats
+
+def fleet_stats(dates, folder='data', workers=None, stats=None):
+    """
+    fleet_stats() computes the statistics of every vessel over a set of days, one day per process, merging the days as they finish
+    Parameters:
+    dates = the days, in YYYY_MM_DD format
+        type = list
+    folder = the folder of the AIS files
+        type = str
+    workers = the number of processes, the number of CPUs by default
+        type = int
+    stats = statistics to add the days to, ex: of earlier months loaded with load_stats()
+        type = dict
+    Returns:
+    stats = the statistics of every vessel over the days
+        type = dict
+    """
+
+    stats = stats or empty_stats([])
+    repeated = sorted(set(stats['dates']).intersection(dates) | set(date for date in dates if list(dates).count(date) > 1))
+    if len(repeated): # Checked before any day is read
+        raise Exception("The statistics of " + ', '.join(repeated) + " are already included!")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(day_stats, ais_day_path(date, folder), date) for date in dates]
+        for future in as_completed(futures):
+            stats = merge_stats(stats, future.result())
+    return stats
+
+def save_stats(stats, path=STATS_PATH):
+    """
+    save_stats() writes statistics to a compressed npz file
+    Parameters:
+    stats = the statistics (see empty_stats())
+        type = dict
+    path = the file's path
+        type = str
+    Returns:
+    None
+    """
+
+    arrays = {'mmsis': stats['mmsis'], 'dates': stats['dates']}
+    for param in BINS:
+        for field in FIELDS:
+            arrays[param + '/' + field] = stats[param][field]
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(path + '.tmp', path)
+
+def load_stats(path=STATS_PATH):
+    """
+    load_stats() reads statistics written by save_stats()
+    Parameters:
+    path = the file's path
+        type = str
+    Returns:
+    stats = the statistics (see empty_stats())
+        type = dict
+    """
+
+    with np.load(path) as arrays:
+        return {'mmsis': arrays['mmsis'], 'dates': arrays['dates'], **{param: {field: arrays[param + '/' + field] for field in FIELDS} for param in BINS}}
+
+def hist_quantiles(hist, edges, q):
+    """
+    hist_quantiles() estimates a quantile of each row of histograms, interpolating linearly within the bin it falls in
+    Parameters:
+    hist = the counts, one histogram per row
+        type = numpy.ndarray
+    edges = the edges of the bins
+        type = numpy.ndarray
+    q = the quantile, between 0 and 1
+        type = float
+    Returns:
+    the quantile of each row, NaN for empty rows
+        type = numpy.ndarray
+    """
+
+    hist = np.atleast_2d(hist)
+    cumulative = hist.cumsum(axis=1)
+    target = q * cumulative[:, -1]
+    column = np.minimum((cumulative < target[:, None]).sum(axis=1), hist.shape[1] - 1)
+    below = np.where(column > 0, cumulative[np.arange(len(hist)), column - 1], 0)
+    inside = hist[np.arange(len(hist)), column]
+    fraction = np.divide(target - below, inside, out=np.zeros(len(hist)), where=inside > 0)
+    quantiles = edges[column] + fraction * (edges[1] - edges[0])
+    return np.where(cumulative[:, -1] > 0, quantiles, np.nan)
+
+def summary(stats, param, quantiles=(0.05, 0.5, 0.95)):
+    """
+    summary() tabulates the statistics of a parameter for every vessel
+    Parameters:
+    stats = the statistics (see empty_stats())
+        type = dict
+    param = the parameter, one of BINS
+        type = str
+    quantiles = the quantiles to estimate from the histograms
+        type = tuple
+    Returns:
+    table = per MMSI, the count, mean, standard deviation, minimum, maximum and quantiles of the values, and the mean and standard
+        deviation of the changes
+        type = pandas.DataFrame
+    """
+
+    accumulators = stats[param]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = accumulators['sum'] / accumulators['n']
+        change_mean = accumulators['change_sum'] / accumulators['change_n']
+        table = pd.DataFrame({'count': accumulators['n'], 'mean': mean,
+                              'std': np.sqrt(np.maximum(accumulators['sumsq'] / accumulators['n'] - mean ** 2, 0)),
+                              'min': accumulators['min'], 'max': accumulators['max']}, index=pd.Index(stats['mmsis'], name='MMSI'))
+        for q in quantiles:
+            table['q' + str(int(round(q * 100)))] = hist_quantiles(accumulators['hist'], bin_edges(param), q)
+        table['change_mean'] = change_mean
+        table['change_std'] = np.sqrt(np.maximum(accumulators['change_sumsq'] / accumulators['change_n'] - change_mean ** 2, 0))
+    return table
+
+def baseline(stats, param, change=False, exclude=None):
+    """
+    baseline() pools the histograms of every vessel into a fleet-wide distribution, to compare an incident ship with
+    Parameters:
+    stats = the statistics (see empty_stats())
+        type = dict
+    param = the parameter, one of BINS
+        type = str
+    change = if True, the distribution of the changes between consecutive broadcasts instead of the values
+        type = bool
+    exclude = MMSIs to leave out, ex: the incident ship's
+        type = list
+    Returns:
+    edges = the edges of the bins
+        type = numpy.ndarray
+    density = the density of each bin, so that it integrates to 1 (like param_hist()'s stat='density')
+        type = numpy.ndarray
+    """
+
+    hist = stats[param]['change_hist' if change else 'hist']
+    keep = ~np.isin(stats['mmsis'], [str(mmsi) for mmsi in exclude or []])
+    counts = hist[keep].sum(axis=0)
+    edges = bin_edges(param, change)
+    total = counts.sum()
+    return edges, counts / (total * (edges[1] - edges[0])) if total else counts.astype(np.float64)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compute per-vessel statistics of daily AIS files, merging them into one statistics file")
+    parser.add_argument('dates', nargs='+', help="dates in YYYY_MM_DD format")
+    parser.add_argument('--folder', default='data', help="folder of the AIS files")
+    parser.add_argument('--output', default=STATS_PATH, help="path of the statistics file")
+    parser.add_argument('--append', action='store_true', help="add the days to the statistics already in the output file")
+    parser.add_argument('--workers', type=int, default=None, help="number of processes, the number of CPUs by default")
+    args = parser.parse_args()
+
+    previous = load_stats(args.output) if args.append and os.path.exists(args.output) else None
+    stats = fleet_stats(args.dates, args.folder, args.workers, previous)
+    save_stats(stats, args.output)
+    print(str(len(stats['mmsis'])) + " vessels over " + str(len(stats['dates'])) + " days -> " + args.output)
@@ -0,0 +1,299 @@
+import argparse
+import os
+import re
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import matplotlib
+from arcgis_datagen import csvgen
+from build_manifest import MANIFEST_PATH, build_inputs, code_version, load_manifest, save_manifest, source_file, source_identity, stale_reason
+from cleaned_ship_graphing import render_standard_plots
+from instrumentation import configure_logging, dump_metrics, get_metrics, merge_metrics, reset_metrics
+from tools import Generic_Mask_Filter, ais_day_path, normalize_sentinels, prefetch
+
+DAYS_PER_TASK = 4 # Days rendered in a row by one process, so the next day's file is read while the current day is rendered
+INPUT_FILES = ['incident_info/allision_inputs.txt', 'incident_info/initial_inputs.txt', 'incident_info/final_inputs.txt']
+
+def read_incidents(path):
+    """
+    read_incidents() parses an incident input file, in either of the layouts used in incident_info/
+        NAME, Incident - MM/DD/YYYY          'NAME, Incident - MM/DD/YYYY'
+            MMSI                      or     'YYYY_MM_DD', 'MMSI'
+            YYYY_MM_DD                       HH:MM:SS
+            HH:MM:SS
+    Parameters:
+    path = the input file's path, ex: 'incident_info/allision_inputs.txt'
+        type = str
+    Returns:
+    incidents = one dictionary per incident, with the title, vessel name, MMSI, date, and time
+        type = list
+    """
+
+    with open(path) as f:
+        blocks = re.split(r'\n\s*\n', f.read().strip())
+
+    incidents = []
+    for block in blocks:
+        title = block.strip().splitlines()[0].strip().strip("'")
+        rest = block[block.index('\n'):] if '\n' in block else ''
+        mmsi = re.search(r'\b\d{9}\b', rest)
+        date = re.search(r'\b\d{4}_\d{2}_\d{2}\b', rest)
+        time = re.search(r'\b\d{2}:\d{2}:\d{2}\b', rest)
+        if not (mmsi and date and time):
+            raise Exception("Could not read the incident '" + title + "' in " + path)
+        incidents.append({'title':title, 'name':title.split(',')[0], 'MMSI':mmsi.group(), 'date':date.group(), 'time':time.group()})
+    return incidents
+
+def ship_key(name):
+    """
+    ship_key() gives the name used for a vessel's output files, ex: 'JAMES E JACKSON' -> 'jamesejackson'
+    Parameters:
+    name = the vessel's name
+        type = str
+    Returns:
+    the lowercase name without spaces or punctuation
+        type = str
+    """
+
+    return re.sub(r'[^a-z0-9]', '', name.lower())
+
+def incident_outputs(incident):
+    """
+    incident_outputs() gives the paths of the coordinates csv and the four standard graphics of an incident
+    Parameters:
+    incident = one incident, as returned by read_incidents()
+        type = dict
+    Returns:
+    outputs = the paths, keyed by 'coordinates', 'hist', 'hist_change', 'scatter' and 'scatter_change'
+        type = dict
+    """
+
+    ship = ship_key(incident['name'])
+    graphics = 'graphics/' + ship + '/' + ship + '_anglediff_'
+    return {'coordinates':'data/coordinates_' + ship + '.csv', 'hist':graphics + 'hist.png', 'hist_change':graphics + 'hist_change.png',
+            'scatter':graphics + 'scatter.png', 'scatter_change':graphics + 'scatter_change.png'}
+
+def render_incident(incident, data):
+    """
+    render_incident() writes the coordinates csv and the four standard angle difference graphics of one incident
+    Parameters:
+    incident = one incident, as returned by read_incidents()
+        type = dict
+    data = the incident vessel's AIS data for the day, as returned by Generic_Mask_Filter()
+        type = pandas.DataFrame
+    Returns:
+    None
+    """
+
+    outputs = incident_outputs(incident)
+    os.makedirs(os.path.dirname(outputs['hist']), exist_ok=True)
+    data = normalize_sentinels(data) # Shared by the csv file and the four graphics
+    csvgen(incident['date'], incident['MMSI'], output=outputs['coordinates'], data=data)
+    render_standard_plots(data, incident['MMSI'], outputs, incident['title'])
+
+def unique_incidents(incidents):
+    """
+    unique_incidents() drops the incidents listed in more than one input file, keeping the first listing of each ship on each day
+    Parameters:
+    incidents = the incidents, as returned by read_incidents()
+        type = list
+    Returns:
+    the incidents without repeats
+        type = list
+    """
+
+    seen = set()
+    unique = []
+    for incident in incidents:
+        if (incident['date'], incident['MMSI']) not in seen:
+            seen.add((incident['date'], incident['MMSI']))
+            unique.append(incident)
+    return unique
+
+def read_day(day):
+    """
+    read_day() reads the AIS data of the incident vessels of one day, or the error that stopped it
+    Parameters:
+    day = the day in YYYY_MM_DD format and its incidents, as returned by read_incidents()
+        type = tuple
+    Returns:
+    data = the vessels' AIS data, or None if it could not be read
+        type = pandas.DataFrame
+    error = the error if the data could not be read, ex: the day's AIS file is missing, or None
+        type = str
+    """
+
+    date, incidents = day
+    try:
+        return Generic_Mask_Filter(ais_day_path(date), MMSI = sorted(set(incident['MMSI'] for incident in incidents))), None
+    except Exception:
+        return None, traceback.format_exc()
+
+def run_date(date, incidents, data=None):
+    """
+    run_date() renders every incident of one day, loading the day's AIS file once for all of them
+        Each incident is isolated, so one failure does not stop the others
+    Parameters:
+    date = the day of the incidents, in YYYY_MM_DD format
+        type = str
+    incidents = the incidents on that day, as returned by read_incidents()
+        type = list
+    data = the incident vessels' AIS data for the day, if it was already read with read_day()
+        type = pandas.DataFrame
+    Returns:
+    results = for each incident, its title and None if it succeeded, or the error if it failed
+        type = list
+    """
+
+    if data is None:
+        data = Generic_Mask_Filter(ais_day_path(date), MMSI = sorted(set(incident['MMSI'] for incident in incidents)))
+
+    results = []
+    for incident in incidents:
+        try:
+            render_incident(incident, data[data['MMSI'] == incident['MMSI']])
+            results.append((incident['title'], None))
+        except Exception:
+            results.append((incident['title'], traceback.format_exc()))
+    return results
+
+def run_days(days):
+    """
+    run_days() renders the incidents of a few days in one process, reading (and decompressing) each day's AIS file in the background
+        while the previous day is rendered
+    Parameters:
+    days = each day in YYYY_MM_DD format with its incidents, as returned by read_incidents()
+        type = list
+    Returns:
+    results = for each day, the title of each incident and None if it succeeded, or the error if it failed
+        type = list
+    metrics = the timers and counters of the days' work in this process (see instrumentation.py)
+        type = dict
+    """
+
+    reset_metrics() # A worker process runs many tasks, each task reports only its own metrics
+    results = []
+    for (date, incidents), (data, error) in prefetch(days, read_day):
+        if error:
+            results.append([(incident['title'], error) for incident in incidents])
+        else:
+            results.append(run_date(date, incidents, data))
+    return results, get_metrics()
+
+def stale_incidents(incidents, manifest, force=False):
+    """
+    stale_incidents() finds the incidents whose outputs must be rendered again, because they are new, their AIS day or parameters
+        changed, the code changed, or an output is missing (see build_manifest.py)
+    Parameters:
+    incidents = the incidents, as returned by read_incidents()
+        type = list
+    manifest = the build manifest, as returned by load_manifest(); the source files' identities of up to date incidents are refreshed
+        type = dict
+    force = if True, every incident is stale
+        type = bool
+    Returns:
+    stale = for each stale incident, the incident, the reason, and its inputs to record in the manifest once it is rendered
+        type = list
+    """
+
+    # Identify each day's source file once, hashing it only if it changed since it was recorded
+    code = code_version()
+    recorded = {record['inputs']['source']['path']: record['inputs']['source'] for record in manifest.values() if record['inputs'].get('source')}
+    sources = {}
+    for date in set(incident['date'] for incident in incidents):
+        path = source_file(date)
+        sources[date] = source_identity(path, recorded.get(path))
+
+    stale = []
+    for incident in incidents:
+        key = ship_key(incident['name'])
+        inputs = build_inputs(sources[incident['date']], incident['MMSI'], incident, code)
+        reason = 'forced' if force else stale_reason(manifest.get(key), inputs, incident_outputs(incident))
+        if reason:
+            stale.append((incident, reason, inputs))
+        else:
+            manifest[key]['inputs'] = inputs # The source file may have been touched without changing
+    return stale
+
+def run_incidents(incidents, workers=None, force=False, manifest_path=MANIFEST_PATH):
+    """
+    run_incidents() renders a set of incidents across a pool of processes, scheduling the incidents that share a day together
+        Only the incidents whose outputs are stale are rendered, and the manifest is updated as each task finishes
+    Parameters:
+    incidents = the incidents to render, as returned by read_incidents()
+        type = list
+    workers = the number of processes, the number of CPUs by default
+        type = int
+    force = if True, every incident is rendered, even if its outputs are up to date
+        type = bool
+    manifest_path = the build manifest's path
+        type = str
+    Returns:
+    failures = the title and error of every incident that failed
+        type = list
+    """
+
+    # Group the stale incidents by day, skipping incidents listed in more than one input file, and the days into tasks of a few days in a row
+    incidents = unique_incidents(incidents)
+    manifest = load_manifest(manifest_path)
+    stale = stale_incidents(incidents, manifest, force)
+    inputs = {(incident['date'], incident['MMSI']): incident_inputs for incident, reason, incident_inputs in stale}
+    dates = {}
+    for incident, reason, incident_inputs in stale:
+        dates.setdefault(incident['date'], []).append(incident)
+    total = len(stale)
+    dates = sorted(dates.items())
+    size = max(min(DAYS_PER_TASK, len(dates) // (workers or os.cpu_count() or 1)), 1) # Spread small runs over every process
+    tasks = [dates[i:i + size] for i in range(0, len(dates), size)]
+    print(str(len(incidents) - total) + " incident(s) up to date, " + str(total) + " to render")
+
+    failures = []
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_days, task): task for task in tasks}
+        for future in as_completed(futures):
+            task = [incident for date, day in futures[future] for incident in day]
+            try:
+                results, metrics = future.result()
+                results = [result for day in results for result in day]
+                merge_metrics(metrics)
+            except Exception: # The whole task failed, ex: its process died
+                results = [(incident['title'], traceback.format_exc()) for incident in task]
+            for incident, (title, error) in zip(task, results):
+                done += 1
+                print(str(done) + "/" + str(total) + " " + title + (" failed" if error else " done"))
+                if error:
+                    failures.append((title, error))
+                else:
+                    manifest[ship_key(incident['name'])] = {'inputs': inputs[(incident['date'], incident['MMSI'])], 'outputs': incident_outputs(incident)}
+            save_manifest(manifest, manifest_path)
+    save_manifest(manifest, manifest_path)
+    return failures
+
+if __name__ == '__main__':
+    # Run as a script, nothing is shown; importing this module (ex: for ship_key()) leaves the caller's backend alone
+    matplotlib.use('Agg')
+    parser = argparse.ArgumentParser(description="Regenerate the coordinates csv files and graphics of the incidents in incident_info/")
+    parser.add_argument('inputs', nargs='*', default=INPUT_FILES, help="incident input files, all of incident_info/ by default")
+    parser.add_argument('--workers', type=int, default=None, help="number of processes, the number of CPUs by default")
+    parser.add_argument('--log-level', default='WARNING', help="DEBUG, INFO, WARNING (default), or ERROR")
+    parser.add_argument('--metrics', default=None, help="path of a JSON file to write the run's stage timers and row counters to")
+    parser.add_argument('--manifest', default=MANIFEST_PATH, help="path of the build manifest")
+    parser.add_argument('--force', action='store_true', help="render every incident, even if its outputs are up to date")
+    parser.add_argument('--dry-run', action='store_true', help="only list the incidents that would be rendered, and why")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    incidents = [incident for path in args.inputs for incident in read_incidents(path)]
+    if args.dry_run:
+        incidents = unique_incidents(incidents)
+        stale = stale_incidents(incidents, load_manifest(args.manifest), args.force)
+        for incident, reason, inputs in stale:
+            print(incident['title'] + ": " + reason)
+        print(str(len(stale)) + " of " + str(len(incidents)) + " incident(s) would be rendered")
+        raise SystemExit(0)
+    failures = run_incidents(incidents, args.workers, args.force, args.manifest)
+    if args.metrics:
+        dump_metrics(args.metrics, inputs=args.inputs, incidents=len(incidents), failures=len(failures))
+    for title, error in failures:
+        print("\n" + title + " failed:\n" + error)
+    raise SystemExit(1 if failures else 0)
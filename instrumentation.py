@@ -0,0 +1,107 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+# Every module logs through logging.getLogger(__name__), so output is silent unless configure_logging() raises the level.
+# Stage timers and row counters are collected per process, read with get_metrics(), and written with dump_metrics().
+metrics = {'timers': {}, 'counters': {}}
+
+def configure_logging(level='WARNING'):
+    """
+    configure_logging() sets how much the pipeline logs: 'DEBUG' for every pass and read, 'INFO' for progress, 'WARNING' for problems only
+    Parameters:
+    level = the logging level's name or number
+        type = str or int
+    Returns:
+    None
+    """
+
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    logging.getLogger().setLevel(level)
+
+@contextmanager
+def stage(name):
+    """
+    stage() times a stage of the pipeline, ex: with stage('read'): ...
+        The calls and total seconds of each stage are added up; stages may be nested, ex: 'filter' inside 'read'
+    Parameters:
+    name = the stage's name, one of 'read', 'filter', 'compact', 'normalise', 'window', 'plot', 'write', 'fleet', 'proximity'
+        type = str
+    Returns:
+    a context manager
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer = metrics['timers'].setdefault(name, {'calls': 0, 'seconds': 0.0})
+        timer['calls'] += 1
+        timer['seconds'] += time.perf_counter() - start
+
+def count(name, rows):
+    """
+    count() adds to a row counter, ex: count('rows_matched', len(df))
+    Parameters:
+    name = the counter's name
+        type = str
+    rows = the number to add
+        type = int
+    Returns:
+    None
+    """
+
+    metrics['counters'][name] = metrics['counters'].get(name, 0) + rows
+
+def get_metrics():
+    """
+    get_metrics() returns a copy of the timers and counters collected since the last reset_metrics()
+    Returns:
+    the timers (calls and seconds of each stage) and the counters
+        type = dict
+    """
+
+    return {'timers': {name: dict(timer) for name, timer in metrics['timers'].items()}, 'counters': dict(metrics['counters'])}
+
+def merge_metrics(other):
+    """
+    merge_metrics() adds the metrics of another process (as returned by its get_metrics()) to this process's metrics
+    Parameters:
+    other = the metrics to add
+        type = dict
+    Returns:
+    None
+    """
+
+    for name, timer in other['timers'].items():
+        total = metrics['timers'].setdefault(name, {'calls': 0, 'seconds': 0.0})
+        total['calls'] += timer['calls']
+        total['seconds'] += timer['seconds']
+    for name, rows in other['counters'].items():
+        count(name, rows)
+
+def reset_metrics():
+    """
+    reset_metrics() clears every timer and counter
+    Returns:
+    None
+    """
+
+    metrics['timers'].clear()
+    metrics['counters'].clear()
+
+def dump_metrics(path, **run):
+    """
+    dump_metrics() writes the metrics of a run to a JSON file
+    Parameters:
+    path = the JSON file's path
+        type = str
+    run = anything else to record about the run, ex: inputs=['incident_info/allision_inputs.txt']
+        type = keyword arguments
+    Returns:
+    None
+    """
+
+    with open(path, 'w') as f:
+        json.dump({**run, **get_metrics()}, f, indent=2, default=str)
@@ -0,0 +1,423 @@
+import argparse
+import itertools
+import logging
+import os
+import numpy as np
+import pandas as pd
+from instrumentation import count, stage
+from tools import EARTH_RADIUS_MILES, Generic_Mask_Filter, ais_day_path, along_track_distance, normalize_sentinels, prefetch
+try:
+    from scipy.spatial import cKDTree
+except ImportError: # The KD-tree is optional, close_pairs() falls back to a grid of cells without it
+    cKDTree = None
+
+logger = logging.getLogger(__name__)
+
+# Every ship's position is interpolated at the same instants, one time bucket apart, so the ships near each other at an instant are
+# found in one spatial query, and the closest approach between two instants is found from the ships' straight-line motion between them
+STEP = pd.Timedelta(minutes=1) # Time between the instants of a neighbour query
+ENCOUNTER_STEP = pd.Timedelta(minutes=2) # Time between the instants of an encounter scan of a whole day
+MAX_GAP = pd.Timedelta(minutes=30) # Ships are not interpolated across longer gaps in their broadcasts
+MAX_SPEED = 40 # Knots; the fastest a ship is assumed to move, so two ships close by at most twice this between two instants
+MIN_SOG = 1 # Knots; an encounter scan only pairs ships with at least one of them moving this fast, so moored ships are not all paired
+COLUMNS = ['MMSI', 'BaseDateTime', 'LAT', 'LON', 'SOG']
+EARTH_RADIUS_NM = EARTH_RADIUS_MILES * 1609.344 / 1852 # Mean radius of the Earth in nautical miles
+AXES = ['x', 'y', 'z']
+
+def project(lat, lon):
+    """
+    project() maps positions to points on a sphere the size of the Earth, in nautical miles from its centre
+        The straight-line distance between two points a few miles apart is then their haversine distance to within a millionth of a
+        mile, anywhere in the data (a flat projection of a whole national day stretches distances far from its origin)
+    Parameters:
+    lat = the latitudes
+        type = numpy.ndarray
+    lon = the longitudes
+        type = numpy.ndarray
+    Returns:
+    points = the x, y and z coordinates of each position, one row per position
+        type = numpy.ndarray
+    """
+
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    return EARTH_RADIUS_NM * np.c_[np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]
+
+def close_pairs(first, second, radius):
+    """
+    close_pairs() finds every pair of points of two sets within a radius of each other, with a KD-tree, or a grid of cells if scipy is missing
+    Parameters:
+    first = the first set of points, one row of coordinates per point
+        type = numpy.ndarray
+    second = the second set of points
+        type = numpy.ndarray
+    radius = the largest distance
+        type = float
+    Returns:
+    i = the index of each pair's point in the first set
+        type = numpy.ndarray
+    j = the index of each pair's point in the second set
+        type = numpy.ndarray
+    """
+
+    if len(first) == 0 or len(second) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if cKDTree is not None:
+        pairs = cKDTree(first).sparse_distance_matrix(cKDTree(second), radius, output_type='ndarray')
+        return pairs['i'].astype(np.int64), pairs['j'].astype(np.int64)
+
+    # Without scipy, pair the points of each cell with the points of its own and the surrounding cells, found by a search of the
+    # sorted cell numbers of the second set
+    def cells(points):
+        cell = np.floor(points / radius).astype(np.int64) + 2**20
+        return (cell * 2**(21 * np.arange(points.shape[1])[::-1])).sum(axis=1)
+
+    keys = cells(second)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    queries = cells(first)
+    i, j = [], []
+    for offsets in itertools.product((-1, 0, 1), repeat=first.shape[1]):
+        shifted = queries + (np.array(offsets) * 2**(21 * np.arange(first.shape[1])[::-1])).sum()
+        low, high = np.searchsorted(keys, shifted), np.searchsorted(keys, shifted, side='right')
+        counts = high - low
+        i.append(np.repeat(np.arange(len(first)), counts))
+        j.append(order[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(low, counts)])
+    i, j = np.concatenate(i), np.concatenate(j)
+    close = np.sqrt(((first[i] - second[j]) ** 2).sum(axis=1)) <= radius
+    return i[close], j[close]
+
+def closest_approach(start, end):
+    """
+    closest_approach() finds where two ships moving in straight lines between two instants are closest
+    Parameters:
+    start = the position of the second ship relative to the first at the first instant (see project()), one row per pair of ships
+        type = numpy.ndarray
+    end = the relative position at the second instant
+        type = numpy.ndarray
+    Returns:
+    distance = the closest distance of each pair
+        type = numpy.ndarray
+    fraction = how far between the instants it is, from 0 to 1
+        type = numpy.ndarray
+    """
+
+    motion = end - start
+    speed = (motion ** 2).sum(axis=1)
+    fraction = np.clip(np.divide(-(start * motion).sum(axis=1), speed, out=np.zeros(len(start)), where=speed > 0), 0, 1)
+    return np.sqrt(((start + fraction[:, None] * motion) ** 2).sum(axis=1)), fraction
+
+class Traffic:
+    """
+    Traffic is the AIS data of every ship over a day, sorted by ship and time, for proximity queries around incident times and
+        encounter scans: which ships came within a distance of each other, how close, and when
+    Parameters:
+    data = AIS data with the MMSI, BaseDateTime, LAT, LON and SOG columns, ex: from read_traffic()
+        type = pandas.DataFrame
+    max_gap = the longest gap in a ship's broadcasts it is interpolated across
+        type = pandas.Timedelta
+    """
+
+    def __init__(self, data, max_gap=MAX_GAP):
+        data = normalize_sentinels(data.dropna(subset=['MMSI', 'BaseDateTime', 'LAT', 'LON']))
+        self.mmsis, vessels = np.unique(data['MMSI'].astype(str).to_numpy(), return_inverse=True)
+        times = data['BaseDateTime'].to_numpy(dtype='datetime64[s]').astype(np.int64)
+        order = np.lexsort((times, vessels))
+        self.vessels = vessels[order]
+        self.times = times[order]
+        self.lat = data['LAT'].to_numpy(dtype=np.float64)[order]
+        self.lon = data['LON'].to_numpy(dtype=np.float64)[order]
+        self.sog = data['SOG'].to_numpy(dtype=np.float64, na_value=np.nan)[order]
+        self.max_gap = int(max_gap.total_seconds())
+        self.origin = self.times.min() if len(self.times) else 0
+        self.keys = self.vessels * 2**32 + (self.times - self.origin) # Sorted; one search finds a ship's broadcasts around an instant
+        self.first = self.times[np.searchsorted(self.vessels, np.arange(len(self.mmsis)))]
+        self.last = self.times[np.searchsorted(self.vessels, np.arange(len(self.mmsis)), side='right') - 1]
+
+    def positions(self, instants, vessels=None):
+        """
+        positions() interpolates ships' positions and speeds at a set of instants, skipping the instants outside a ship's broadcasts
+        Parameters:
+        instants = the instants, in seconds since 1970, sorted
+            type = numpy.ndarray
+        vessels = the ships, as positions in self.mmsis; every ship by default
+            type = numpy.ndarray
+        Returns:
+        samples = one row per ship and instant, sorted by ship and then instant, with the instant's index in instants, the ship,
+            its position (x, y and z, see project()) and its SOG
+            type = pandas.DataFrame
+        """
+
+        vessels = np.arange(len(self.mmsis)) if vessels is None else np.asarray(vessels)
+        low = np.searchsorted(instants, self.first[vessels])
+        high = np.searchsorted(instants, self.last[vessels], side='right')
+        counts = np.maximum(high - low, 0)
+        vessel = np.repeat(vessels, counts)
+        instant = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(low, counts)
+        seconds = instants[instant]
+
+        # The broadcasts at or after and before each instant; an instant on a broadcast uses it as it is
+        after = np.searchsorted(self.keys, vessel * 2**32 + (seconds - self.origin))
+        before = np.where(self.times[after] == seconds, after, after - 1)
+        gap = self.times[after] - self.times[before]
+        fraction = np.divide(seconds - self.times[before], gap, out=np.zeros(len(gap)), where=gap > 0)
+        lat = self.lat[before] + fraction * (self.lat[after] - self.lat[before])
+        lon = self.lon[before] + fraction * (self.lon[after] - self.lon[before])
+        sog = self.sog[before] + fraction * (self.sog[after] - self.sog[before])
+        samples = pd.DataFrame(project(lat, lon), columns=AXES).assign(instant=instant, vessel=vessel, SOG=sog)
+        return samples[gap <= self.max_gap].reset_index(drop=True)
+
+    def neighbours(self, MMSI, start, end, radius, step=STEP):
+        """
+        neighbours() finds the ships that came within a radius of a ship during a time window, with their closest approach
+        Parameters:
+        MMSI = the ship's MMSI
+            type = str
+        start = the start of the window
+            type = pandas.Timestamp
+        end = the end of the window
+            type = pandas.Timestamp
+        radius = the distance, in nautical miles
+            type = float
+        step = the time between the instants the ships' positions are compared at
+            type = pandas.Timedelta
+        Returns:
+        neighbours = one row per ship, closest first, with its MMSI, the closest distance in nautical miles and its time
+            type = pandas.DataFrame
+        """
+
+        vessel = np.searchsorted(self.mmsis, str(MMSI))
+        if vessel == len(self.mmsis) or self.mmsis[vessel] != str(MMSI):
+            raise Exception("There are no broadcasts of ship " + str(MMSI) + "!")
+        step = int(step.total_seconds())
+        instants = np.arange(pd.Timestamp(start).floor('s').value // 10**9, pd.Timestamp(end).value // 10**9 + 1, step)
+
+        with stage('proximity'):
+            # The ship's own positions, looked up by instant; only one ship is compared with every other, so no spatial index is needed
+            own = self.positions(instants, [vessel])
+            points = np.full((len(instants), len(AXES)), np.nan)
+            points[own['instant'].to_numpy()] = own[AXES].to_numpy()
+            samples = self.positions(instants)
+            samples = samples[samples['vessel'] != vessel]
+            relative = samples[AXES].to_numpy() - points[samples['instant'].to_numpy()]
+            distance = np.sqrt((relative ** 2).sum(axis=1))
+            time = instants[samples['instant']].astype(np.float64)
+
+            # The closest approach between an instant and the next, when both ships have positions at both
+            following = (samples['vessel'].to_numpy()[1:] == samples['vessel'].to_numpy()[:-1]) & \
+                        (samples['instant'].to_numpy()[1:] == samples['instant'].to_numpy()[:-1] + 1) & \
+                        ~np.isnan(distance[1:]) & ~np.isnan(distance[:-1])
+            between, fraction = closest_approach(relative[:-1][following], relative[1:][following])
+            vessels = np.r_[samples['vessel'].to_numpy(), samples['vessel'].to_numpy()[:-1][following]]
+            distance = np.r_[distance, between]
+            time = np.r_[time, time[:-1][following] + fraction * step]
+
+        close = distance <= radius
+        found = pd.DataFrame({'vessel': vessels[close], 'Distance': distance[close], 'time': time[close]})
+        found = found.sort_values('Distance').drop_duplicates('vessel')
+        count('neighbours', len(found))
+        return pd.DataFrame({'MMSI': self.mmsis[found['vessel']], 'Distance': found['Distance'].to_numpy(),
+                             'Time': pd.to_datetime(np.round(found['time'].to_numpy()).astype(np.int64), unit='s')})
+
+    def encounters(self, radius, step=ENCOUNTER_STEP, min_sog=MIN_SOG):
+        """
+        encounters() scans the whole day for every pair of ships that came within a radius of each other, with their closest approach
+            At each instant the positions go into a KD-tree (or grid), which is searched within the radius plus the distance the ships
+            could close before the next instant, and the pairs found are then measured between the instants
+        Parameters:
+        radius = the distance, in nautical miles
+            type = float
+        step = the time between the instants the ships' positions are compared at
+            type = pandas.Timedelta
+        min_sog = the speed in knots at least one ship of a pair must be going, 0 to pair moored ships too
+            type = float
+        Returns:
+        encounters = one row per pair of ships, closest first, with both MMSIs, the closest distance in nautical miles and its time
+            type = pandas.DataFrame
+        """
+
+        step = int(step.total_seconds())
+        if len(self.times) == 0:
+            return pd.DataFrame({'MMSI': [], 'Other': [], 'Distance': [], 'Time': pd.to_datetime([])})
+        instants = np.arange(self.times.min() // step * step, self.times.max() + step, step)
+        reach = radius + 2 * MAX_SPEED * step / 3600 # Two ships heading at each other close at up to twice the speed of one
+
+        with stage('proximity'):
+            samples = self.positions(instants).sort_values(['instant', 'vessel'], kind='stable')
+            points = samples[AXES].to_numpy()
+            moving = ~(samples['SOG'].to_numpy() < min_sog)
+            bounds = np.searchsorted(samples['instant'].to_numpy(), np.arange(len(instants) + 1))
+            found = []
+            for index in range(len(instants)):
+                rows = np.arange(bounds[index], bounds[index + 1])
+                movers = rows[moving[rows]]
+                i, j = close_pairs(points[movers], points[rows], reach)
+                found.append(np.c_[movers[i], rows[j]])
+            found = np.concatenate(found) if found else np.zeros((0, 2), dtype=np.int64)
+
+            # Each pair once, first ship first, then their closest approach at the instant and until the next instant
+            vessel = samples['vessel'].to_numpy()
+            found = found[vessel[found[:, 0]] != vessel[found[:, 1]]]
+            found = np.where((vessel[found[:, 0]] < vessel[found[:, 1]])[:, None], found, found[:, ::-1])
+            found = np.unique(found, axis=0)
+            first, second = found[:, 0], found[:, 1]
+            start = points[second] - points[first]
+            distance = np.sqrt((start ** 2).sum(axis=1))
+            time = instants[samples['instant'].to_numpy()[first]].astype(np.float64)
+
+            keys = samples['instant'].to_numpy() * len(self.mmsis) + vessel # Sorted, like the samples
+            following = [np.searchsorted(keys, keys[rows] + len(self.mmsis)) for rows in (first, second)]
+            following = [np.minimum(rows, len(keys) - 1) for rows in following]
+            both = (keys[following[0]] == keys[first] + len(self.mmsis)) & (keys[following[1]] == keys[second] + len(self.mmsis))
+            between, fraction = closest_approach(start[both], points[following[1][both]] - points[following[0][both]])
+            closer = between < distance[both]
+            distance[np.flatnonzero(both)[closer]] = between[closer]
+            time[np.flatnonzero(both)[closer]] += fraction[closer] * step
+
+        close = distance <= radius
+        pairs = pd.DataFrame({'MMSI': self.mmsis[vessel[first[close]]], 'Other': self.mmsis[vessel[second[close]]],
+                              'Distance': distance[close], 'time': time[close]})
+        pairs = pairs.sort_values('Distance').drop_duplicates(['MMSI', 'Other']).reset_index(drop=True)
+        pairs['Time'] = pd.to_datetime(np.round(pairs.pop('time').to_numpy()).astype(np.int64), unit='s')
+        count('encounters', len(pairs))
+        logger.info("%d encounters within %s nautical miles", len(pairs), radius)
+        return pairs
+
+def check_distances(tolerance=1e-4):
+    """
+    check_distances() checks the distances the queries measure against the haversine formula, at places across the data's range
+        (including beside the antimeridian), that two ships held 0.6 nautical miles apart are found within 0.7, and that two ships
+        passing head-on between two instants are found at their closest approach
+    Parameters:
+    tolerance = the largest error allowed, in nautical miles
+        type = float
+    Returns:
+    error = the largest error found, in nautical miles
+        type = float
+    """
+
+    error = 0
+    for lat, lon in [(29.7, -95.0), (47.6, -122.3), (61.2, -149.9), (52.0, 179.99), (44.6, -67.0), (18.4, -66.1)]:
+        for distance, bearing in itertools.product([0.6, 1.59, 5], [0, 45, 90, 135]):
+            # The point at a distance and bearing from the place, on the same sphere as the haversine formula
+            angle, bearing, start = distance / EARTH_RADIUS_NM, np.radians(bearing), np.radians(lat)
+            end = np.arcsin(np.sin(start) * np.cos(angle) + np.cos(start) * np.sin(angle) * np.cos(bearing))
+            other = lon + np.degrees(np.arctan2(np.sin(bearing) * np.sin(angle) * np.cos(start), np.cos(angle) - np.sin(start) * np.sin(end)))
+            haversine = along_track_distance([lat, np.degrees(end)], [lon, other])[-1] * 1609.344 / 1852
+            points = project([lat, np.degrees(end)], [lon, other])
+            measured = np.sqrt(((points[1] - points[0]) ** 2).sum())
+            error = max(error, abs(measured - distance), abs(haversine - distance))
+
+    # Two ships going north off Houston for 10 minutes, one 0.6 miles ahead of the other
+    times = pd.date_range('2019-01-01 12:00', periods=61, freq='10s')
+    north = 6 / 3600 / 60 * 10 * np.arange(61) # Degrees of latitude covered at 6 knots
+    data = pd.DataFrame({'MMSI': ['366000001'] * 61 + ['366000002'] * 61, 'BaseDateTime': list(times) * 2,
+                         'LAT': np.r_[29.7 + north, 29.7 + np.degrees(0.6 / EARTH_RADIUS_NM) + north], 'LON': -95.0, 'SOG': 6.0})
+    traffic = Traffic(data)
+    near = traffic.neighbours('366000001', times[0], times[-1], 0.7)
+    pairs = traffic.encounters(0.7)
+    if len(near) != 1 or len(pairs) != 1:
+        raise Exception("Two ships 0.6 nautical miles apart were not found within 0.7!")
+    error = max(error, abs(near['Distance'].iloc[0] - 0.6), abs(pairs['Distance'].iloc[0] - 0.6))
+
+    # Two ships at 35 knots heading at each other, 0.1 miles apart abeam, passing 20 seconds before an instant of the encounter scan
+    times = pd.date_range('2019-01-01 12:10', periods=121, freq='10s')
+    east = 35 / 3600 / 60 / np.cos(np.radians(29.7)) * (times - pd.Timestamp('2019-01-01 12:21:40')).total_seconds().to_numpy()
+    data = pd.DataFrame({'MMSI': ['366000001'] * 121 + ['366000002'] * 121, 'BaseDateTime': list(times) * 2,
+                         'LAT': np.r_[np.full(121, 29.7), np.full(121, 29.7 + np.degrees(0.1 / EARTH_RADIUS_NM))],
+                         'LON': np.r_[-95.0 + east, -95.0 - east], 'SOG': 35.0})
+    traffic = Traffic(data)
+    near = traffic.neighbours('366000001', times[0], times[-1], 0.5)
+    pairs = traffic.encounters(0.5)
+    if len(near) != 1 or len(pairs) != 1 or pairs['Time'].iloc[0] != pd.Timestamp('2019-01-01 12:21:40'):
+        raise Exception("Two ships passing 0.1 nautical miles apart head-on were not found at their closest approach!")
+    error = max(error, abs(near['Distance'].iloc[0] - 0.1), abs(pairs['Distance'].iloc[0] - 0.1))
+    if error > tolerance:
+        raise Exception("Distances are off by up to " + str(error) + " nautical miles!")
+    return error
+
+def read_traffic(file_path):
+    """
+    read_traffic() reads every ship's positions and speeds from a day of AIS data
+    Parameters:
+    file_path = the path of the AIS csv (or zip) file
+        type = str
+    Returns:
+    traffic = the day's traffic
+        type = Traffic
+    """
+
+    return Traffic(Generic_Mask_Filter(file_path, columns=COLUMNS, cache=False))
+
+def incident_traffic(incidents, radius=2, window=pd.Timedelta(hours=1), folder='data', output='data'):
+    """
+    incident_traffic() writes the ships that came near each incident ship around the incident's time, reading each day once
+    Parameters:
+    incidents = the incidents, as returned by read_incidents()
+        type = list
+    radius = the distance, in nautical miles
+        type = float
+    window = how long before and after the incident to look
+        type = pandas.Timedelta
+    folder = the folder of the AIS files
+        type = str
+    output = the folder to write a 'traffic_' + ship + '.csv' file per incident to
+        type = str
+    Returns:
+    paths = the path written for each incident, in order, or None where the day's file or the incident ship's broadcasts are missing
+        type = list
+    """
+
+    from incident_runner import ship_key
+    dates = sorted(set(incident['date'] for incident in incidents))
+    os.makedirs(output, exist_ok=True)
+    paths = {}
+
+    def load(date):
+        try:
+            return read_traffic(ais_day_path(date, folder))
+        except Exception as error: # A missing day only skips its own incidents
+            return error
+
+    for date, traffic in prefetch(dates, load):
+        for incident in incidents:
+            if incident['date'] == date and isinstance(traffic, Exception):
+                logger.error("Skipping %s: %s", incident['title'], traffic)
+                paths[id(incident)] = None
+            elif incident['date'] == date:
+                time = pd.Timestamp(date.replace('_', '-') + ' ' + incident['time'])
+                try:
+                    near = traffic.neighbours(incident['MMSI'], time - window, time + window, radius)
+                except Exception as error: # One ship missing from its day does not stop the other incidents
+                    logger.error("Skipping %s: %s", incident['title'], error)
+                    paths[id(incident)] = None
+                    continue
+                near['Minutes'] = (near['Time'] - time).dt.total_seconds() / 60 # Before (negative) or after the incident
+                path = os.path.join(output, 'traffic_' + ship_key(incident['name']) + '.csv')
+                near.to_csv(path, index=False)
+                logger.info("%d ships within %s nautical miles of %s", len(near), radius, incident['title'])
+                paths[id(incident)] = path
+    return [paths[id(incident)] for incident in incidents]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find the ships near the incident ships around the incidents, or every encounter of a day")
+    parser.add_argument('inputs', nargs='*', help="incident input files, the files in incident_info/ by default")
+    parser.add_argument('--radius', type=float, default=2, help="distance in nautical miles")
+    parser.add_argument('--minutes', type=float, default=60, help="minutes before and after each incident to look")
+    parser.add_argument('--encounters', metavar='YYYY_MM_DD', help="write every encounter of a day instead")
+    parser.add_argument('--folder', default='data', help="folder of the AIS files")
+    parser.add_argument('--check', action='store_true', help="check the measured distances against the haversine formula, and exit")
+    args = parser.parse_args()
+
+    if args.check:
+        print("Distances within " + str(check_distances()) + " nautical miles of the haversine formula")
+    elif args.encounters:
+        pairs = read_traffic(ais_day_path(args.encounters, args.folder)).encounters(args.radius)
+        pairs.to_csv('data/encounters_' + args.encounters + '.csv', index=False)
+        print(str(len(pairs)) + " encounters -> data/encounters_" + args.encounters + ".csv")
+    else:
+        from incident_runner import INPUT_FILES, read_incidents, unique_incidents
+        incidents = unique_incidents([incident for path in args.inputs or INPUT_FILES for incident in read_incidents(path)])
+        for path in incident_traffic(incidents, args.radius, pd.Timedelta(minutes=args.minutes), args.folder):
+            if path:
+                print(path)
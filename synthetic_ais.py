@@ -0,0 +1,124 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from tools import EARTH_RADIUS_MILES
+
+AIS_COLUMNS = ['MMSI', 'BaseDateTime', 'LAT', 'LON', 'SOG', 'COG', 'Heading', 'VesselName', 'IMO', 'CallSign', 'VesselType', 'Status',
+               'Length', 'Width', 'Draft', 'Cargo', 'TransceiverClass']
+BRIDGE = (29.70, -95.03, 29.71, -95.00) # LAT, LON of both ends of the synthetic bridge span
+
+def generate_day(date, vessels=1000, points=500, crossing=0.1, sentinels=0.05, seed=0, folder='data'):
+    """
+    generate_day() writes a deterministic, MarineCadastre-formatted day of AIS data, and a bridge csv file of the passes under BRIDGE in it
+        Each ship sails a noisy straight track at a steady speed, reporting every 10 to 120 seconds; a share of the ships is routed
+        across the bridge. Heading 511, COG 360, negative COG, negative SOG and SOG 102.3 sentinels are sprinkled through the data,
+        except on the points either side of a pass
+    Parameters:
+    date = the day to generate, in YYYY_MM_DD format
+        type = str
+    vessels = the number of ships (MMSIs)
+        type = int
+    points = the number of broadcasts of each ship, before dropping the ones past midnight
+        type = int
+    crossing = the share of ships that pass under the bridge
+        type = float
+    sentinels = the share of broadcasts with each kind of sentinel value
+        type = float
+    seed = the seed of the random generator, the same seed gives the same files
+        type = int
+    folder = where to write the files
+        type = str
+    Returns:
+    ais_path = the path of the AIS csv file, '<folder>/AIS_<date>.csv'
+        type = str
+    bridge_path = the path of the bridge csv file, '<folder>/bridge_<date>.csv', in the format bridge_reader() reads
+        type = str
+    """
+
+    rng = np.random.default_rng(seed)
+    day = pd.Timestamp(date.replace('_', '-'))
+
+    # Ship particulars, one per MMSI
+    mmsis = 366000000 + rng.choice(999999, size=vessels, replace=False)
+    widths = rng.integers(8, 60, size=vessels)
+    ships = pd.DataFrame({'MMSI': mmsis.astype(str), 'VesselName': ['SYNTHETIC ' + str(i) for i in range(vessels)],
+                          'IMO': ['IMO' + str(9000000 + i) for i in range(vessels)], 'CallSign': ['WSY' + str(1000 + i) for i in range(vessels)],
+                          'VesselType': rng.choice([31, 52, 70, 80], size=vessels), 'Status': rng.choice([0, 0, 0, 5, 12], size=vessels),
+                          'Length': widths * 6, 'Width': widths, 'Draft': np.round(rng.uniform(2, 12, size=vessels), 1),
+                          'Cargo': rng.choice([70, 80, 81], size=vessels), 'TransceiverClass': rng.choice(['A', 'B'], size=vessels, p=[0.8, 0.2])})
+
+    # Report times: each ship starts at a random time and reports every 10 to 120 seconds
+    seconds = rng.integers(10, 121, size=(vessels, points)).cumsum(axis=1)
+    seconds += rng.integers(0, 86400 - int(seconds[:, -1].mean()) // 2, size=(vessels, 1))
+
+    # Steady course and speed with a little noise; crossing ships are aimed through the bridge's middle, halfway through their track
+    speeds = rng.uniform(3, 14, size=vessels) # knots
+    courses = rng.uniform(0, 360, size=vessels)
+    crossers = rng.random(vessels) < crossing
+    span = np.degrees(np.arctan2(BRIDGE[3] - BRIDGE[1], BRIDGE[2] - BRIDGE[0]))
+    courses[crossers] = (span + rng.choice([90, 270], size=crossers.sum()) + rng.uniform(-20, 20, size=crossers.sum())) % 360
+    cog = (courses[:, None] + rng.normal(0, 3, size=(vessels, points))) % 360
+    sog = np.clip(speeds[:, None] + rng.normal(0, 0.5, size=(vessels, points)), 0, 30)
+    heading = np.round(cog + rng.normal(0, 4, size=(vessels, points))) % 360
+
+    # Dead reckoning from the first point; crossing ships are shifted so the bridge's middle falls between their middle two points
+    steps = np.concatenate([np.zeros((vessels, 1)), np.diff(seconds, axis=1) * sog[:, 1:] / 3600 * 1.15078], axis=1) # statute miles
+    north = (steps * np.cos(np.radians(cog))).cumsum(axis=1)
+    east = (steps * np.sin(np.radians(cog))).cumsum(axis=1)
+    middle = points // 2
+    north[crossers] -= (north[crossers, middle - 1:middle] + north[crossers, middle:middle + 1]) / 2
+    east[crossers] -= (east[crossers, middle - 1:middle] + east[crossers, middle:middle + 1]) / 2
+    origin_lat = rng.uniform(25, 45, size=vessels)
+    origin_lon = rng.uniform(-124, -70, size=vessels)
+    origin_lat[crossers] = (BRIDGE[0] + BRIDGE[2]) / 2
+    origin_lon[crossers] = (BRIDGE[1] + BRIDGE[3]) / 2
+    lat = origin_lat[:, None] + np.degrees(north / EARTH_RADIUS_MILES)
+    lon = origin_lon[:, None] + np.degrees(east / (EARTH_RADIUS_MILES * np.cos(np.radians(origin_lat[:, None]))))
+
+    df = pd.DataFrame({'ship': np.repeat(np.arange(vessels), points), 'point': np.tile(np.arange(points), vessels),
+                       'seconds': seconds.ravel(), 'LAT': np.round(lat.ravel(), 5), 'LON': np.round(lon.ravel(), 5),
+                       'SOG': np.round(sog.ravel(), 1), 'COG': np.round(cog.ravel(), 1), 'Heading': heading.ravel().astype(int)})
+
+    # Passes: the points of crossing ships either side of the bridge line
+    side = np.sign((BRIDGE[2] - BRIDGE[0]) * (df['LON'] - BRIDGE[1]) - (BRIDGE[3] - BRIDGE[1]) * (df['LAT'] - BRIDGE[0]))
+    passes = df['ship'].map(dict(enumerate(crossers))).to_numpy() & (df['point'].isin([middle - 1, middle])).to_numpy()
+    flips = side.groupby(df['ship']).diff().fillna(0).to_numpy() != 0
+    pass_ships = df.loc[passes & flips & (df['point'] == middle).to_numpy() & (df['seconds'] < 86400).to_numpy(), 'ship']
+    in_pass = df['ship'].isin(pass_ships).to_numpy() & passes
+
+    # Sentinels, never on the points of a pass
+    for column, values in [('Heading', [511]), ('COG', [360.0]), ('SOG', [102.3])]:
+        hit = (rng.random(len(df)) < sentinels) & ~in_pass
+        df.loc[hit, column] = rng.choice(values, size=hit.sum())
+    negative_cog = (rng.random(len(df)) < sentinels) & ~in_pass & (df['COG'] != 360.0).to_numpy()
+    df.loc[negative_cog, 'COG'] = np.round(df.loc[negative_cog, 'COG'] - 409.6, 1)
+    negative_sog = (rng.random(len(df)) < sentinels) & ~in_pass & (df['SOG'] != 102.3).to_numpy()
+    df.loc[negative_sog, 'SOG'] = np.round(df.loc[negative_sog, 'SOG'] - 102.4, 1)
+
+    # Drop the broadcasts past midnight, add the particulars, and order the file by time like the MarineCadastre files
+    df = df[df['seconds'] < 86400]
+    df['BaseDateTime'] = (day + pd.to_timedelta(df['seconds'], unit='s')).dt.strftime('%Y-%m-%dT%H:%M:%S')
+    df = df.join(ships, on='ship')
+    df = df.sort_values(['seconds', 'ship'], kind='stable')
+    in_pass = df['ship'].isin(pass_ships) & df['point'].isin([middle - 1, middle])
+
+    os.makedirs(folder, exist_ok=True)
+    ais_path = os.path.join(folder, 'AIS_' + date + '.csv')
+    bridge_path = os.path.join(folder, 'bridge_' + date + '.csv')
+    df[AIS_COLUMNS].to_csv(ais_path, index=False)
+    bridges = df[in_pass].sort_values(['ship', 'point'])
+    bridges[AIS_COLUMNS].to_csv(bridge_path, index=False)
+    return ais_path, bridge_path
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate synthetic MarineCadastre AIS day files and matching bridge pass files")
+    parser.add_argument('dates', nargs='+', help="dates in YYYY_MM_DD format")
+    parser.add_argument('--vessels', type=int, default=1000)
+    parser.add_argument('--points', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--folder', default='data')
+    args = parser.parse_args()
+
+    for i, date in enumerate(args.dates):
+        print(' and '.join(generate_day(date, args.vessels, args.points, seed=args.seed + i, folder=args.folder)))
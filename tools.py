@@ -1,15 +1,382 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
+from instrumentation import count, stage
+
+logger = logging.getLogger(__name__)
+
+# Column types of MarineCadastre AIS Broadcast Data, shared by every reader of the daily files
+AIS_DTYPES = {"Heading": "Int64",
+              "VesselName": str,
+              "IMO": str,
+              "MMSI": str, #Technically this should be an integer, but some files accidentally insert an alphanumeric character, causing a ValueError
+              "LAT": np.float64,
+              "LON": np.float64,
+              "SOG": np.float64,
+              "COG": np.float64,
+              "CallSign": str,
+              "VesselType": "Int64",
+              "Status": "Int64",
+              "Length": "Int64",
+              "Width": "Int64",
+              "Cargo": "Int64",
+              "Draft": np.float64,
+              "TransceiverClass": str,
+              "TranscieverClass": str}
+
+# Narrower types used when Generic_Mask_Filter(compact=True): repeated strings become categoricals, small enums small integers,
+# and kinematics float32 (SOG, COG and Draft have one decimal). LAT and LON stay float64, since float32 would round them by up to a meter
+AIS_COMPACT_DTYPES = {"Heading": "Int16",
+                      "VesselName": "category",
+                      "IMO": "category",
+                      "MMSI": "category",
+                      "SOG": np.float32,
+                      "COG": np.float32,
+                      "CallSign": "category",
+                      "VesselType": "Int16",
+                      "Status": "Int8",
+                      "Length": "Int16",
+                      "Width": "Int16",
+                      "Cargo": "Int16",
+                      "Draft": np.float32,
+                      "TransceiverClass": "category",
+                      "TranscieverClass": "category"}
+
+AIS_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S' # The fixed ISO format of BaseDateTime in the daily files
+
+def read_ais_csv(file_path, usecols=None, chunksize=None):
+    """
+    read_ais_csv() reads a CSV File of AIS Broadcast Data with the column types every function in this repo expects
+    Parameters:
+    file_path = the path of the AIS csv file, which may be zipped as published by MarineCadastre (AIS_YYYY_MM_DD.zip), and is then
+        decompressed as it is read, without being extracted
+        type = str
+    usecols = the columns to parse, all columns by default
+        type = list or callable
+    chunksize = if given, the number of rows in each chunk returned by an iterator instead of a single DataFrame
+        type = int
+    Returns:
+    df = the AIS data
+        type = pandas.DataFrame (or an iterator of DataFrames if chunksize is given)
+    """
+
+    return pd.read_csv(file_path, sep=',', header=0, usecols=usecols, dtype=AIS_DTYPES, on_bad_lines="skip", chunksize=chunksize)
+
+def ais_day_path(date, folder='data'):
+    """
+    ais_day_path() gives the file of a day of AIS data: AIS_<date>.csv, or the AIS_<date>.zip download if the csv file was not extracted
+    Parameters:
+    date = the day, in YYYY_MM_DD format
+        type = str
+    folder = the folder of the AIS files
+        type = str
+    Returns:
+    the path of the csv file if it exists, else of the zip file if it exists, else of the (missing) csv file
+        type = str
+    """
+
+    path = os.path.join(folder, 'AIS_' + date + '.csv')
+    if not os.path.exists(path) and os.path.exists(path[:-len('.csv')] + '.zip'):
+        return path[:-len('.csv')] + '.zip'
+    return path
+
+def ais_day_exists(file_path):
+    """
+    ais_day_exists() checks whether an AIS file can be read: the csv (or zip) file itself, or its columnar store once that file is deleted
+    Parameters:
+    file_path = the path of the AIS file, as given by ais_day_path()
+        type = str
+    Returns:
+    True if Generic_Mask_Filter() can read the file, False otherwise
+        type = bool
+    """
+
+    from ais_store import store_is_current
+    return os.path.exists(file_path) or store_is_current(file_path)
+
+def prefetch(items, load, ahead=1):
+    """
+    prefetch() loads items on a background thread ahead of their use, so reading and decompressing the next day's file overlaps
+        with the processing of the current one, ex: for date, data in prefetch(dates, lambda date: Generic_Mask_Filter(...)): ...
+    Parameters:
+    items = the items to load, in the order they are used
+        type = list
+    load = loads one item; an exception it raises is raised when its item is reached
+        type = function
+    ahead = how many items to load ahead of the one in use, 0 to load each item only when it is reached
+        type = int
+    Returns:
+    an iterator of each item with what load() returned for it
+        type = generator
+    """
+
+    items = list(items)
+    pool = ThreadPoolExecutor(max_workers=1)
+    try:
+        futures = [pool.submit(load, item) for item in items[:ahead]]
+        for i, item in enumerate(items):
+            if i + ahead < len(items):
+                futures.append(pool.submit(load, items[i + ahead])) # At most ahead items are loaded beyond the one in use
+            result = futures[i].result()
+            futures[i] = None # Do not hold on to the items already used
+            yield item, result
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def parse_times(df):
+    """
+    parse_times() parses the BaseDateTime column of AIS data once, with its known fixed format, into datetime64 values
+        Data whose BaseDateTime is already parsed (or that has no BaseDateTime) is returned as it is
+    Parameters:
+    df = AIS data
+        type = pandas.DataFrame
+    Returns:
+    df = the data with BaseDateTime as datetime64 (NaT where a time cannot be read)
+        type = pandas.DataFrame
+    """
+
+    if 'BaseDateTime' not in df.columns or pd.api.types.is_datetime64_any_dtype(df['BaseDateTime']):
+        return df
+    return df.assign(BaseDateTime=pd.to_datetime(df['BaseDateTime'], format=AIS_TIME_FORMAT, errors='coerce'))
+
+def fractional_hours(times):
+    """
+    fractional_hours() gives the time of day of each time in hours, ex: 13:30:36 -> 13.51
+    Parameters:
+    times = parsed times, ex: the BaseDateTime column returned by Generic_Mask_Filter()
+        type = pandas.Series
+    Returns:
+    hours = the hours since midnight of each time's own day
+        type = pandas.Series
+    """
+
+    return (times - times.dt.normalize()) / pd.Timedelta(hours=1)
+
+def parse_mmsi(mmsi):
+    """
+    parse_mmsi() cleans MMSIs read as strings, repairing the stray characters some files insert, ex: ' 3669954a31' -> '366995431'
+        An MMSI that is still not 9 digits once its other characters are dropped is kept as it was read
+    Parameters:
+    mmsi = the MMSIs
+        type = pandas.Series
+    Returns:
+    mmsi = the cleaned MMSIs, as strings
+        type = pandas.Series
+    """
+
+    mmsi = mmsi.str.strip()
+    digits = mmsi.str.replace(r'\D', '', regex=True)
+    return mmsi.where(mmsi.str.fullmatch(r'\d{9}') | (digits.str.len() != 9), digits)
+
+def compact_frame(df):
+    """
+    compact_frame() converts AIS data to the narrower types of AIS_COMPACT_DTYPES, so a day (or several) takes a fraction of the memory
+        The MMSIs are cleaned with parse_mmsi() and kept as categorical strings, so they compare and filter like the MMSIs of uncompacted data
+    Parameters:
+    df = AIS data with the types of AIS_DTYPES, ex: as read by read_ais_csv()
+        type = pandas.DataFrame
+    Returns:
+    df = the same data in the compact types
+        type = pandas.DataFrame
+    """
+
+    with stage('compact'):
+        df = df.copy()
+        if 'MMSI' in df.columns:
+            df['MMSI'] = parse_mmsi(df['MMSI'])
+        for column, dtype in AIS_COMPACT_DTYPES.items():
+            if column in df.columns:
+                df[column] = df[column].astype(dtype)
+    return df
+
+def apply_conditions(df, conditions):
+    """
+    apply_conditions() keeps the rows of a DataFrame that satisfy every condition, with the "and" condition between columns and the "or" condition between values in a column
+    Parameters:
+    df = AIS data
+        type = pandas.DataFrame
+    conditions = the values to keep for each column, ex: {'MMSI': ['12345'], 'Status': [2]}
+        type = dict
+    Returns:
+    df = the rows satisfying every condition
+        type = pandas.DataFrame
+    """
+
+    with stage('filter'):
+        for column, requirements in conditions.items():
+            df = df.loc[df[column].isin(requirements)]
+    return df
+
+def read_filtered(file_path, conditions, columns=None, chunksize=None, compact=False):
+    """
+    read_filtered() reads the rows of an AIS file that satisfy every condition, from the fastest source available:
+        the columnar store, the MMSI byte-offset index, or the CSV itself (streamed in chunks if chunksize is given)
+    Parameters:
+    file_path = the path of the AIS csv file
+        type = str
+    conditions = the values to keep for each column, with the same and/or semantics as Generic_Mask_Filter()
+        type = dict
+    columns = the columns to return, all columns by default
+        type = list
+    chunksize = the number of rows in each chunk when streaming the CSV
+        type = int
+    compact = whether to convert the data to the compact types (see compact_frame())
+        type = bool
+    Returns:
+    df = the data satisfying every condition
+        type = pandas.DataFrame
+    """
+
+    # Read from the columnar store when it is up to date with the CSV
+    from ais_store import read_store, store_is_current
+    if store_is_current(file_path):
+        df = parse_times(read_store(file_path, conditions, columns))
+        return compact_frame(df) if compact else df
+
+    # Only parse the requested columns and the columns needed by the conditions
+    usecols = None
+    if columns:
+        wanted = set(columns) | set(conditions)
+        usecols = lambda column: column in wanted
+
+    # Seek to the lines of the requested ships when the CSV has an up to date MMSI index
+    from ais_index import load_index, read_indexed
+    index = load_index(file_path) if "MMSI" in conditions else None
+
+    if index is not None:
+        df = read_indexed(file_path, index, conditions, usecols)
+    elif chunksize:
+        # Apply each condition to every chunk, so only the matching rows are kept in memory
+        chunks = [apply_conditions(chunk, conditions) for chunk in read_ais_csv(file_path, usecols, chunksize)]
+        df = pd.concat(chunks) if chunks else read_ais_csv(file_path, usecols).iloc[0:0]
+    else:
+        # Apply each condition to the DataFrame
+        df = apply_conditions(read_ais_csv(file_path, usecols), conditions)
+
+    if columns:
+        df = df[[column for column in df.columns if column in columns]]
+
+    df = parse_times(df)
+    return compact_frame(df) if compact else df
+
+EARTH_RADIUS_MILES = 3958.7613 # Mean radius of the Earth in statute miles
+
+def along_track_distance(lat, lon):
+    """
+    along_track_distance() gives the cumulative distance travelled along a track at each of its points, using the haversine formula
+        This stays within ~0.5% of geopy's ellipsoidal distance, and is computed for the whole track at once
+    Parameters:
+    lat = the latitudes of the track's points, in time order
+        type = list, numpy.ndarray, or pandas.Series
+    lon = the longitudes of the track's points, in time order
+        type = list, numpy.ndarray, or pandas.Series
+    Returns:
+    distance = the distance in miles from the first point to each point, along the track
+        type = numpy.ndarray
+    """
+
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    if len(lat) == 0:
+        return np.zeros(0)
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    steps = 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+    return np.concatenate(([0.0], np.cumsum(steps)))
+
+def as_angles(angle):
+    """
+    as_angles() converts angles of any form into a float array, with missing values as NaN
+    Parameters:
+    angle = the input angle(s)
+        type = int, float, list, numpy.ndarray, or pandas.Series
+    Returns:
+    angles = the angle(s) as floats
+        type = numpy.ndarray
+    """
+
+    if isinstance(angle, (pd.Series, pd.Index)):
+        return angle.to_numpy(dtype=np.float64, na_value=np.nan)
+    return np.asarray(angle, dtype=np.float64)
+
+def like_angles(angle, angles):
+    """
+    like_angles() returns computed angles in the same form as the input they were computed from
+    Parameters:
+    angle = the input angle(s)
+        type = int, float, list, numpy.ndarray, or pandas.Series
+    angles = the computed angle(s)
+        type = numpy.ndarray
+    Returns:
+    angles = a float for a single input angle, a Series (with the same index) for a Series, and an array otherwise
+        type = float, numpy.ndarray, or pandas.Series
+    """
+
+    if isinstance(angle, pd.Series):
+        return pd.Series(angles, index=angle.index, name=angle.name)
+    if angles.ndim == 0:
+        return float(angles)
+    return angles
+
+def angle_difference(cog, heading):
+    """
+    angle_difference() gives the angle difference between a ship's course over ground and its heading, according to the rules of true_difference()
+    Parameters:
+    cog = the course(s) over ground, with the AIS sentinels already removed (see normalize_sentinels())
+        type = int, float, list, numpy.ndarray, or pandas.Series
+    heading = the heading(s), with the AIS sentinels already removed
+        type = int, float, list, numpy.ndarray, or pandas.Series
+    Returns:
+    diff = the angle difference(s)
+        type = float, numpy.ndarray, or pandas.Series (in the form of cog, see like_angles())
+    """
+
+    return true_difference(pos_angle(cog), pos_angle(heading))
+
+def normalize_sentinels(data):
+    """
+    normalize_sentinels() replaces the values AIS uses for "not available" with missing values, and adjusts the encoded negative values,
+        according to https://coast.noaa.gov/data/marinecadastre/ais/faq.pdf
+        COG: 360 is not available, negative values are shifted by 409.6
+        Heading: 511 is not available
+        SOG: negative values are shifted by 102.4, after which 102.3 and above is not available
+    Parameters:
+    data = AIS data, with any of the COG, Heading, and SOG columns
+        type = pandas.DataFrame
+    Returns:
+    data = a copy of the data with the sentinels replaced by NaN (or <NA> for the Int64 Heading)
+        type = pandas.DataFrame
+    Data that was already normalised (marked in data.attrs) is returned as it is, so it can be shared by several plots
+    """
+
+    if data.attrs.get('sentinels_normalized'):
+        return data
+    with stage('normalise'):
+        data = data.copy()
+        if 'COG' in data.columns:
+            cog = data['COG']
+            data['COG'] = cog.mask(cog == 360.0).mask(cog < 0, cog + 409.6)
+        if 'Heading' in data.columns:
+            data['Heading'] = data['Heading'].mask(data['Heading'] == 511)
+        if 'SOG' in data.columns:
+            sog = data['SOG'].mask(data['SOG'] < 0, data['SOG'] + 102.4)
+            data['SOG'] = sog.mask(sog >= 102.3)
+        data.attrs['sentinels_normalized'] = True
+    return data
 
 # Generic_Mask_Filter() written by Diran Jimenez
 def Generic_Mask_Filter(file_path, MMSI=False, BaseDateTime=False, LAT=False, LON=False, SOG=False, COG=False,
                         Heading=False, VesselName = False, IMO = False, CallSign = False, VesselType = False,
-                        Status = False, Length = False, Width = False, Draft = False, Cargo = False, TransceiverClass = False):
+                        Status = False, Length = False, Width = False, Draft = False, Cargo = False, TransceiverClass = False,
+                        columns = None, chunksize = None, cache = True, compact = False):
     """
     Parameters
     ----------
     file_path : string
         This string should point to a CSV File of AIS Broadcast Data you wish to filter.
+        It may be a zipped CSV File (see ais_day_path()), which is decompressed
+            as it is read, without being extracted.
     ALL OTHER PARAMETERS: List
        
         Each parameter corresponds to a column of AIS Broadcast Data
@@ -29,6 +396,35 @@ def Generic_Mask_Filter(file_path, MMSI=False, BaseDateTime=False, LAT=False, LO
             Generic_Mask_Filter(MMSI = [12345, 99999]) will return broadcasts
             that have MMSI = 12345 || MMSI = 99999
                 Note that the "or" condition is denoted with "||" by pandas and numpy
+
+    columns : list, optional
+        The columns to return. By default every column of the file is returned.
+
+        If a columnar store of the file exists (see ais_store.py), the data is
+            read from the store instead of the CSV, and both the columns and
+            the conditions are pushed down into the read. Otherwise only the
+            columns and the columns with conditions are parsed from the CSV.
+
+    chunksize : int, optional
+        If given, the CSV is streamed in chunks of this many rows and the
+            conditions are applied to each chunk before the chunks are joined,
+            so peak memory follows the number of matching rows instead of the
+            size of the file. The result is the same as without chunksize.
+
+    If the CSV has an MMSI byte-offset index (see ais_index.py) and an MMSI
+        condition is given, only the lines of those ships are read.
+
+    cache : bool, optional
+        If True (the default), the result is kept in the cache of ais_cache.py,
+            keyed by the file's path, size and modification time, the
+            conditions and the columns, so reading the same ship from the same
+            file again does not parse the file again.
+
+    compact : bool, optional
+        If True, the data is returned in the narrower types of
+            AIS_COMPACT_DTYPES (see compact_frame()), which take several times
+            less memory. The conditions are applied before the conversion, so
+            they match exactly as they do without compact.
        
     Returns
     -------
@@ -36,56 +432,52 @@ def Generic_Mask_Filter(file_path, MMSI=False, BaseDateTime=False, LAT=False, LO
         A DataFrame that has data which satisfies all criterion passed as input
         conditions.
 
+        BaseDateTime is parsed once into datetime64 values (see parse_times()),
+            but conditions on BaseDateTime are still written as in the file,
+            ex: BaseDateTime = ['2019-01-08T02:20:00']
+
     """
     # locals() creates a dictionary containing all local variables
     conditions = locals()
     del conditions["file_path"]
-        # The only variable not tied to a condition is the file_path
-
-    df = pd.read_csv(file_path, sep=',', header=0, dtype={"Heading": "Int64",
-                                                               "VesselName": str,
-                                                               "IMO":str,
-                                                               "MMSI":str, #Technically this should be an integer, but some files accidentally insert an alphanumeric character, causing a ValueError
-                                                               "LAT":np.float64,
-                                                               "LON":np.float64,
-                                                               "SOG":np.float64,
-                                                               "Heading":"Int64",
-                                                               "COG":np.float64,
-                                                               "IMO":str,
-                                                               "CallSign":str,
-                                                               "VesselType":"Int64",
-                                                               "Status":"Int64",
-                                                               "Length":"Int64",
-                                                               "Width":"Int64",
-                                                               "Cargo":"Int64",
-                                                               "Draft":np.float64,
-                                                               "TransceiverClass":str,
-                                                               "TranscieverClass":str}, on_bad_lines="skip")
-   
-    # Apply each condition to the DataFrame
-    for column, requirements in conditions.items():
-        if requirements:
-            df = df.loc[df[column].isin(requirements)]
+    del conditions["columns"]
+    del conditions["chunksize"]
+    del conditions["cache"]
+    del conditions["compact"]
+        # The only variables not tied to a condition are the file_path and the reading options
+    conditions = {column: requirements for column, requirements in conditions.items() if requirements}
+
+    with stage('read'):
+        if cache:
+            from ais_cache import cached_read
+            df = cached_read(file_path, conditions, columns, lambda: read_filtered(file_path, conditions, columns, chunksize, compact), compact)
+        else:
+            df = read_filtered(file_path, conditions, columns, chunksize, compact)
 
+    count('rows_matched', len(df))
+    logger.debug("Read %d rows of %s matching %s", len(df), file_path, conditions)
     return df
 
 # Code from here written by Lemon Doroshow
 def pos_angle(angle):
     """
     pos_angle() converts angles from negative degrees to positive degrees while maintaining the same magnitude and orientation, and also adjusts angles above 360 degrees to be within the range [0,360]
+    Works on a single angle or element-wise on a list, array, or Series of angles (missing values stay missing)
     Parameters:
-    angle = the input angle
-        type = int
+    angle = the input angle(s)
+        type = int, float, list, numpy.ndarray, or pandas.Series
     Returns:
-    angle = the angle, adjusted to be positive (as low as possible)
-        type = int
+    angle = the angle(s), adjusted to be positive (as low as possible)
+        type = float, numpy.ndarray, or pandas.Series (see like_angles())
     """
 
-    while angle < 0:
-        angle += 360
-    while angle > 360:
-        angle -= 360
-    return angle
+    # Add or remove whole turns the same way a loop on each angle would, so results are identical to the float
+    angles = as_angles(angle)
+    while np.any(angles < 0):
+        angles = np.where(angles < 0, angles + 360, angles)
+    while np.any(angles > 360):
+        angles = np.where(angles > 360, angles - 360, angles)
+    return like_angles(angle, angles)
 
 def true_difference(angle1, angle2):
     """
@@ -94,26 +486,20 @@ def true_difference(angle1, angle2):
     If -180 < true_difference < 0, then angle1 is counterclockwise of angle2, measured by itnerior angle
     Angles with a difference of 0, -180, or 180 are left unchanged
     It is recommended for pos_angle() to be used on both angles beforehand
+    Works on single angles or element-wise on lists, arrays, or Series of angles (a missing angle gives a missing difference)
     Parameters:
-    angle1 = the first angle, according to the rules above
-        type = int
-    angle2 = the second angle, according to the rules above
-        type = int
+    angle1 = the first angle(s), according to the rules above
+        type = int, float, list, numpy.ndarray, or pandas.Series
+    angle2 = the second angle(s), according to the rules above
+        type = int, float, list, numpy.ndarray, or pandas.Series
     Returns:
     diff = the difference of the angles as described above
-        type = int
+        type = float, numpy.ndarray, or pandas.Series (in the form of angle1, see like_angles())
     """
 
-    if angle1-angle2 > 180:
-        diff = (-1)*(360 - angle1 + angle2)
-    if angle1-angle2 < -180:
-        diff = 360 + angle1 - angle2
-    if angle1-angle2 > -180 and angle1-angle2 < 180:
-        diff = angle1-angle2
-    if angle1-angle2 == 180:
-        diff = 180
-    if angle1-angle2 == -180:
-        diff = -180
-    if angle1-angle2 == 0:
-        diff = 0
-    return diff
+    angles1 = as_angles(angle1)
+    angles2 = as_angles(angle2)
+    diff = angles1 - angles2
+    diff = np.where(diff > 180, (-1)*(360 - angles1 + angles2), diff)
+    diff = np.where(diff < -180, 360 + angles1 - angles2, diff)
+    return like_angles(angle1, diff)
@@ -0,0 +1,195 @@
+import logging
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from tools import Generic_Mask_Filter, ais_day_exists, ais_day_path
+
+logger = logging.getLogger(__name__)
+
+MAX_DAYS = 3 # Days of a track kept loaded, and the longest run of days a window may span: the day before, of, and after a pass
+
+def adjacent_day(date, days):
+    """
+    adjacent_day() gives the day a number of days before or after another, ex: adjacent_day('2019_01_01', -1) -> '2018_12_31'
+    Parameters:
+    date = the day, in YYYY_MM_DD format
+        type = str
+    days = how many days after (or before, if negative)
+        type = int
+    Returns:
+    the other day, in YYYY_MM_DD format
+        type = str
+    """
+
+    return (pd.Timestamp(date.replace('_', '-')) + pd.Timedelta(days=days)).strftime('%Y_%m_%d')
+
+def shared_day_loader(mmsis, folder='data', max_days=MAX_DAYS):
+    """
+    shared_day_loader() gives a loader for the tracks of many ships, which reads each day once for all of the ships, ex: for param_collection_batch()
+    Parameters:
+    mmsis = the MMSIs of the ships
+        type = list
+    folder = the folder of the AIS files
+        type = str
+    max_days = how many days to keep loaded
+        type = int
+    Returns:
+    load = a function of a day and an MMSI returning that ship's data for the day, or None if there is no file for the day
+        type = function
+    """
+
+    loaded = OrderedDict() # date -> (the day's data, split by MMSI), or None if there is no file for the day
+
+    def load(date, MMSI):
+        if date not in loaded:
+            path = ais_day_path(date, folder)
+            data = Generic_Mask_Filter(path, MMSI=list(mmsis)) if ais_day_exists(path) else None
+            loaded[date] = None if data is None else (data, {str(mmsi): track for mmsi, track in data.groupby('MMSI', observed=True)})
+            while len(loaded) > max_days:
+                loaded.popitem(last=False)
+        loaded.move_to_end(date)
+        if loaded[date] is None:
+            return None
+        data, tracks = loaded[date]
+        return tracks.get(str(MMSI), data.iloc[0:0])
+
+    return load
+
+class VesselTrack:
+    """
+    VesselTrack is the AIS track of one ship across the daily files. Days are read only when a window reaches past the days already
+        loaded, and the last few days read are kept, so passes near midnight (or windows longer than the rest of the day) are
+        collected across the day boundary without reading whole weeks up front
+    Parameters:
+    MMSI = the ship's MMSI
+        type = str
+    folder = the folder of the AIS files
+        type = str
+    max_days = how many days to keep loaded, and the most days a window may span
+        type = int
+    loader = a function of a day and an MMSI returning the ship's data for the day, or None if there is no file for the day;
+        by default each day is read with Generic_Mask_Filter()
+        type = function
+    days = days already loaded, ex: {'2019_01_08': data}, so they are not read again
+        type = dict
+    """
+
+    def __init__(self, MMSI, folder='data', max_days=MAX_DAYS, loader=None, days=None):
+        self.MMSI = str(MMSI)
+        self.folder = folder
+        self.max_days = max_days
+        self.loader = loader or self.read_day
+        self.days = OrderedDict(days or {}) # date -> the ship's data for the day, or None if there is no file for the day
+        self.filtered = {} # (param, first day, last day) -> the days' data passed through param_filter()
+
+    def read_day(self, date, MMSI):
+        """
+        read_day() reads one day of the ship's data, the default loader
+        Parameters:
+        date = the day, in YYYY_MM_DD format
+            type = str
+        MMSI = the ship's MMSI
+            type = str
+        Returns:
+        data = the ship's data for the day, or None if there is no file for the day
+            type = pandas.DataFrame
+        """
+
+        path = ais_day_path(date, self.folder)
+        return Generic_Mask_Filter(path, MMSI=[MMSI]) if ais_day_exists(path) else None
+
+    def day(self, date):
+        """
+        day() gives one day of the ship's data, reading it if it is not loaded and dropping the least recently used day past max_days
+        Parameters:
+        date = the day, in YYYY_MM_DD format
+            type = str
+        Returns:
+        data = the ship's data for the day, or None if there is no file for the day
+            type = pandas.DataFrame
+        """
+
+        if date not in self.days:
+            logger.debug("Loading %s of ship %s", date, self.MMSI)
+            self.days[date] = self.loader(date, self.MMSI)
+            while len(self.days) > self.max_days:
+                dropped = self.days.popitem(last=False)[0]
+                self.filtered = {key: data for key, data in self.filtered.items() if not key[1] <= dropped <= key[2]}
+        self.days.move_to_end(date)
+        return self.days[date]
+
+    def span(self, first, last, param):
+        """
+        span() gives the ship's data from one day to another, passed through param_filter() for a parameter
+        Parameters:
+        first = the first day, in YYYY_MM_DD format
+            type = str
+        last = the last day, in YYYY_MM_DD format
+            type = str
+        param = the parameter about to be collected (see param_collection())
+            type = str
+        Returns:
+        data = the filtered data of every day from first to last, sorted by time
+            type = pandas.DataFrame
+        """
+
+        from bridge_pass_collection import param_filter
+        key = (param, first, last)
+        if key not in self.filtered:
+            dates = [first]
+            while dates[-1] != last:
+                dates.append(adjacent_day(dates[-1], 1))
+            frames = [self.day(date) for date in dates]
+            if all(frame is None for frame in frames):
+                raise Exception("There is no AIS file for " + first + " in " + self.folder + "!")
+            self.filtered[key] = param_filter(pd.concat([frame for frame in frames if frame is not None]), param)
+        return self.filtered[key]
+
+    def has_data(self, date):
+        """
+        has_data() checks whether the ship has any data on a day, reading the day if needed
+        Parameters:
+        date = the day, in YYYY_MM_DD format
+            type = str
+        Returns:
+        True if the day's file exists and has points of the ship
+            type = bool
+        """
+
+        data = self.day(date)
+        return data is not None and len(data) > 0
+
+    def collect(self, passing, param, radius=5):
+        """
+        collect() collects a parameter within a radius upstream and downstream of one pass of the ship, like pass_window(),
+            reading the days before and after the pass only if the window runs off the data already loaded
+        Parameters:
+        passing = one pass, as a row of bridge_reader()'s output
+            type = namedtuple
+        param = the parameter to collect (see param_collection())
+            type = str
+        radius = how far to collect up and downstream of the pass, in miles along the track
+            type = float
+        Returns:
+        collection = the values of the parameter around the pass, from the pass back in time and then from the pass forward in time
+            type = list
+        """
+
+        from bridge_pass_collection import pass_window, window_bounds
+        first = passing.time_before.strftime('%Y_%m_%d')
+        last = passing.time_after.strftime('%Y_%m_%d')
+        while True:
+            data = self.span(first, last, param)
+            times = data['BaseDateTime']
+            days = (pd.Timestamp(last.replace('_', '-')) - pd.Timestamp(first.replace('_', '-'))).days + 1
+
+            # Extend the data a day back or forward while the window runs off its start or end and the ship has data on that day
+            before = np.flatnonzero((times == passing.time_before).to_numpy())
+            after = np.flatnonzero((times == passing.time_after).to_numpy())
+            start, end = window_bounds(data['Distance'].to_numpy(), before[0], after[0], radius) if len(before) and len(after) else (0, 0)
+            if days < self.max_days and start < 0 and self.has_data(adjacent_day(first, -1)):
+                first = adjacent_day(first, -1)
+            elif days < self.max_days and end > len(data) and self.has_data(adjacent_day(last, 1)):
+                last = adjacent_day(last, 1)
+            else:
+                return pass_window(data, passing, param, radius)